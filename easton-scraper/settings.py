@@ -133,8 +133,77 @@ LOGGING = {
     'loggers': {
         'django': {
             'handlers': ['file'],
-            'level': 'DEBUG',
+            # DEBUG logs every parsed row, which slows scraping down; set it only while debugging the parsers
+            'level': 'INFO',
             'propagate': True,
         },
     },
-}
\ No newline at end of file
+}
+
+# Scraper
+
+# Number of threads used to fetch and parse gym calendars concurrently
+SCRAPER_WORKERS = 8
+# Processes the "threads" engine parses and classifies pages in, instead of on the fetch threads.  The pool is started
+# by the first scrape (about a second per process) and reused by later ones in the same process; it pays off when
+# parsing is a large share of a scrape, e.g. many days of many gyms on a multi-core host.  0 parses on the fetch
+# threads.  At most SCRAPER_PARSE_QUEUE_SIZE pages (default:  twice the processes) wait for parsing before fetches do.
+SCRAPER_PARSE_PROCESSES = 0
+SCRAPER_PARSE_QUEUE_SIZE = None
+
+# "threads" (SCRAPER_WORKERS blocking fetches at a time) or "asyncio" (SCRAPER_MAX_IN_FLIGHT requests on one thread)
+SCRAPER_ENGINE = 'threads'
+SCRAPER_MAX_IN_FLIGHT = 200
+
+# Seconds before a single page fetch is abandoned
+SCRAPER_FETCH_TIMEOUT = 30
+
+# zencalendar class times are cached per (gym, appointment ID) for this many seconds, up to this many entries
+SCRAPER_ZEN_DETAIL_CACHE_TTL = 7 * 24 * 60 * 60
+SCRAPER_ZEN_DETAIL_CACHE_SIZE = 10000
+
+# MindBody schedule IDs (read from each gym's Easton schedule page) are re-resolved after this many seconds
+SCRAPER_SCHEDULE_ID_TTL = 7 * 24 * 60 * 60
+
+# Seconds without a stored batch before a scrape job is taken to have died (failed, and its gyms' locks freed)
+SCRAPER_LOCK_TTL = 60 * 60
+
+# ETag / Last-Modified validators for conditional requests; unchanged pages (304) aren't parsed again.
+# None disables conditional requests.
+SCRAPER_HTTP_CACHE_DIR = os.path.join(BASE_DIR, 'http_cache')
+
+# Keep-alive connections kept idle per host, and seconds before an idle one is closed
+SCRAPER_POOL_SIZE = 10
+SCRAPER_POOL_IDLE_TIMEOUT = 30
+
+# Rendered search responses (get-checks, classes.json) kept in memory per process, until the next scrape
+SCRAPER_RESPONSE_CACHE_SIZE = 256
+# ... and at most this many bytes of them
+SCRAPER_RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+
+# Classifications (category, requirements) memoized per distinct (MindBody header, class name)
+SCRAPER_CLASSIFICATION_CACHE_SIZE = 4096
+
+# BeautifulSoup parser for fetched pages:  "html.parser" (standard library), or "lxml" (faster, needs lxml installed)
+SCRAPER_HTML_PARSER = 'html.parser'
+# Parse only the tags each page is read for (table rows, calendar days, the schedule widget) instead of whole pages
+SCRAPER_HTML_STRAINERS = True
+
+# Parse MindBody print views incrementally as they download (threaded engine) instead of after the whole page arrives
+SCRAPER_STREAM_PARSING = False
+
+# Skip parsing pages whose content hash matches the last scrape, and writing rows that haven't changed
+SCRAPER_DIFFERENTIAL = True
+
+# Classes that started more than SCRAPER_RETENTION_DAYS ago are moved to the archive table (by the archive_classes
+# command, or after every successful scrape with SCRAPER_ARCHIVE_AFTER_SCRAPE), SCRAPER_ARCHIVE_BATCH rows at a time
+SCRAPER_RETENTION_DAYS = 14
+SCRAPER_ARCHIVE_AFTER_SCRAPE = False
+SCRAPER_ARCHIVE_BATCH = 500
+
+# "record":  save every response a scrape receives to SCRAPER_CASSETTE_PATH (gzipped JSON)
+# "replay":  serve a scrape from that file through a local stand-in server, SCRAPER_REPLAY_LATENCY seconds a response
+# None:  fetch live
+SCRAPER_CASSETTE_MODE = None
+SCRAPER_CASSETTE_PATH = None
+SCRAPER_REPLAY_LATENCY = 0
@@ -0,0 +1,257 @@
+from django.test import RequestFactory
+
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+import json
+import os
+import statistics
+import time
+
+from . import models, views
+
+
+# *** Constants ***
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+# Recorded pages parsed by the benchmarks
+MINDBODY_FIXTURE = 'mindbody_print.html'
+ZEN_CALENDAR_FIXTURE = 'zen_calendar.html'
+ZEN_ENROLLMENT_FIXTURE = 'zen_enrollment.html'
+CLASS_NAMES_FIXTURE = 'class_names.json'
+FIXTURE_FIRST_DATE = datetime(2019, 3, 10)
+
+# Times each stage is run, the fastest run is reported
+DEFAULT_REPEAT = 5
+# Pages parsed per run of a parse stage
+PARSE_PAGES = 20
+# Classes stored for the upsert and search stages
+DEFAULT_SEARCH_CLASSES = 2000
+# A stage slower than its previous result by more than this fraction is reported as a regression
+DEFAULT_REGRESSION_TOLERANCE = 0.10
+
+# MindBody category headers the recorded class names are classified under
+MINDBODY_CATEGORIES = [None, "", "Adult BJJ", "Muay Thai", "Youth BJJ", "Strength and Conditioning", "Little Tigers",
+                       "Kids", "Kids BJJ", "Tigers", "Seminar", "Kids Muay Thai", "Youth Kickboxing", "Open Mat",
+                       "Open Gym", "Striking", "Pro Fight Team", "Tigers Seminar"]
+
+
+#
+# One benchmarked stage
+#
+# run:  the timed work, called once per repeat
+# items:  rows (or pages) handled by one run(), for items_per_second
+# setup:  optional, called untimed before each run()
+#
+BenchmarkStage = namedtuple('BenchmarkStage', ['run', 'items', 'setup'])
+
+
+def read_fixture(file_name):
+    with open(os.path.join(TESTDATA_DIR, file_name), 'rb') as fixture:
+        return fixture.read()
+
+
+#
+# Run the scrape and search stages on recorded pages, without any network access
+#
+# The upsert and search stages read and write EastonClass rows in the default database, so callers should point it
+# at a throwaway one (the benchmark command runs on a test database).
+#
+# params:
+# repeat:  runs per stage
+# search_classes:  classes stored for the upsert and search stages
+# stage_names:  only run these stages (default:  all of BENCHMARK_STAGES)
+#
+# returns:  OrderedDict of stage name -> {'items', 'repeat', 'best_seconds', 'median_seconds', 'items_per_second'}
+#
+def run_benchmarks(repeat=DEFAULT_REPEAT, search_classes=DEFAULT_SEARCH_CLASSES, stage_names=None):
+
+    results = OrderedDict()
+    for name, get_stage in BENCHMARK_STAGES:
+        if stage_names and name not in stage_names:
+            continue
+        results[name] = time_stage(get_stage(search_classes), repeat)
+    return results
+
+
+def time_stage(stage, repeat):
+
+    timings = []
+    for _ in range(repeat):
+        if stage.setup:
+            stage.setup()
+        start = time.perf_counter()
+        stage.run()
+        timings.append(time.perf_counter() - start)
+    best_seconds = min(timings)
+    return {
+        'items': stage.items,
+        'repeat': repeat,
+        'best_seconds': round(best_seconds, 6),
+        'median_seconds': round(statistics.median(timings), 6),
+        'items_per_second': round(stage.items / best_seconds, 1) if best_seconds else None,
+    }
+
+
+#
+# Compare two run_benchmarks results (e.g. saved by the benchmark command on different commits)
+#
+# returns:  list of (stage name, previous items/s, current items/s, fractional change, regressed), for the stages
+# in both
+#
+def compare_results(previous, current, tolerance=DEFAULT_REGRESSION_TOLERANCE):
+
+    comparison = []
+    for name, result in current.items():
+        previous_rate = previous.get(name, {}).get('items_per_second')
+        current_rate = result.get('items_per_second')
+        if not previous_rate or not current_rate:
+            continue
+        change = current_rate / previous_rate - 1
+        comparison.append((name, previous_rate, current_rate, change, change < -tolerance))
+    return comparison
+
+
+# *** Stages ***
+
+def get_mindbody_parse_stage(search_classes):
+    html = read_fixture(MINDBODY_FIXTURE)
+    calendar = models.MindBodyDailyCalendar(models.EastonGym.AR, None, FIXTURE_FIRST_DATE)
+    rows = len(calendar.parse_class_data(html))
+
+    def run():
+        for _ in range(PARSE_PAGES):
+            calendar.parse_class_data(html)
+    return BenchmarkStage(run, rows * PARSE_PAGES, None)
+
+
+def get_mindbody_stream_parse_stage(search_classes):
+    html = read_fixture(MINDBODY_FIXTURE)
+    calendar = models.MindBodyDailyCalendar(models.EastonGym.AR, None, FIXTURE_FIRST_DATE)
+    rows = len(list(calendar.iter_class_data([html])))
+
+    def run():
+        for _ in range(PARSE_PAGES):
+            for _ in calendar.iter_class_data([html]):
+                pass
+    return BenchmarkStage(run, rows * PARSE_PAGES, None)
+
+
+def get_zen_calendar_parse_stage(search_classes):
+    html = read_fixture(ZEN_CALENDAR_FIXTURE)
+    rows = sum(len(calendar_items) for calendar_items in models.parse_calendar_week(html).values())
+
+    def run():
+        for _ in range(PARSE_PAGES):
+            models.parse_calendar_week(html)
+    return BenchmarkStage(run, rows * PARSE_PAGES, None)
+
+
+def get_zen_enrollment_parse_stage(search_classes):
+    html = read_fixture(ZEN_ENROLLMENT_FIXTURE)
+
+    def run():
+        for _ in range(PARSE_PAGES):
+            models.parse_class_time(html)
+    return BenchmarkStage(run, PARSE_PAGES, None)
+
+
+def get_classify_stage(search_classes, memoized=True):
+    with open(os.path.join(TESTDATA_DIR, CLASS_NAMES_FIXTURE)) as names_file:
+        names = json.load(names_file)
+    easton_classes = []
+    for mindbody_category in MINDBODY_CATEGORIES:
+        for name in names:
+            easton_class = models.EastonClass(name=name)
+            easton_class.mindbody_category = mindbody_category
+            easton_classes.append(easton_class)
+
+    def run():
+        for easton_class in easton_classes:
+            models.get_list_category(easton_class)
+
+    def clear_cache():
+        # Loading the rules again drops every memoized classification
+        models.CLASS_CLASSIFIER.load_rules(models.CLASS_RULES)
+    return BenchmarkStage(run, len(easton_classes), None if memoized else clear_cache)
+
+
+def get_upsert_insert_stage(search_classes):
+    batch = []
+
+    def setup():
+        models.EastonClass.objects.all().delete()
+        batch[:] = make_search_classes(search_classes)
+    return BenchmarkStage(lambda: models.bulk_upsert(batch), search_classes, setup)
+
+
+def get_upsert_update_stage(search_classes):
+    batch = []
+
+    def setup():
+        store_search_classes(search_classes)
+        batch[:] = make_search_classes(search_classes, name_suffix=" (updated)")
+    return BenchmarkStage(lambda: models.bulk_upsert(batch), search_classes, setup)
+
+
+def get_classes_stage(search_classes):
+
+    def run():
+        list(models.get_classes([gym.name for gym in models.EastonGym],
+                                [category.name for category in models.EastonClassCategory],
+                                [requirements.name for requirements in models.EastonRequirements]))
+    return BenchmarkStage(run, search_classes, lambda: store_search_classes(search_classes))
+
+
+def get_checks_stage(search_classes, cached=False):
+    # A page of results, as only pages are cached
+    request = RequestFactory().get('/get-checks/', {'page-size': views.MAX_PAGE_SIZE})
+
+    def setup():
+        store_search_classes(search_classes)
+        views.RESPONSE_CACHE.clear()
+        if cached:
+            views.get_checks(request)
+    return BenchmarkStage(lambda: views.get_checks(request), min(search_classes, views.MAX_PAGE_SIZE), setup)
+
+
+BENCHMARK_STAGES = [
+    ('parse_mindbody', get_mindbody_parse_stage),
+    ('parse_mindbody_stream', get_mindbody_stream_parse_stage),
+    ('parse_zen_calendar', get_zen_calendar_parse_stage),
+    ('parse_zen_enrollment', get_zen_enrollment_parse_stage),
+    ('classify', lambda search_classes: get_classify_stage(search_classes, memoized=False)),
+    ('classify_memoized', get_classify_stage),
+    ('upsert_insert', get_upsert_insert_stage),
+    ('upsert_update', get_upsert_update_stage),
+    ('get_classes', get_classes_stage),
+    ('get_checks', get_checks_stage),
+    ('get_checks_cached', lambda search_classes: get_checks_stage(search_classes, cached=True)),
+]
+
+
+#
+# Search classes for the upsert and search stages:  the recorded MindBody classes, repeated over every gym and as
+# many days as needed, each with its own class ID
+#
+def make_search_classes(count, name_suffix=""):
+    calendar = models.MindBodyDailyCalendar(models.EastonGym.AR, None, FIXTURE_FIRST_DATE)
+    recorded_classes = calendar.parse_class_data(read_fixture(MINDBODY_FIXTURE))
+    gyms = list(models.EastonGym)
+    easton_classes = []
+    for number in range(count):
+        recorded_class = recorded_classes[number % len(recorded_classes)]
+        day = timedelta(days=number // (len(recorded_classes) * len(gyms)))
+        easton_classes.append(models.EastonClass(
+            gym=gyms[number // len(recorded_classes) % len(gyms)], class_id=str(number),
+            name=recorded_class.name + name_suffix, start_time=recorded_class.start_time + day,
+            end_time=recorded_class.end_time + day, category=recorded_class.category,
+            requirements=recorded_class.requirements))
+    return easton_classes
+
+
+# Stores exactly the classes from make_search_classes(count)
+def store_search_classes(count):
+    models.EastonClass.objects.all().delete()
+    models.bulk_upsert(make_search_classes(count))
@@ -0,0 +1,265 @@
+from django.conf import settings
+from django.utils import timezone
+
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger('django')
+
+
+# *** Constants ***
+
+CASSETTE_MODE_RECORD = "record"
+CASSETTE_MODE_REPLAY = "replay"
+CASSETTE_VERSION = 1
+# Response headers kept in a cassette, the rest describe the original connection rather than the page
+CASSETTE_HEADERS = ('Content-Type', 'Location', 'ETag', 'Last-Modified')
+
+
+#
+# Recorded responses, one per URL (the last one seen), and the first day the recorded scrape asked for
+#
+# Saved as gzipped JSON.  Bodies are kept as text (UTF-8, undecodable bytes escaped) rather than base64 so the
+# cassette compresses about as well as the pages themselves.
+#
+class Cassette:
+
+    def __init__(self, responses=None, first_date=None):
+        self._lock = threading.Lock()
+        # url -> {'status', 'reason', 'headers', 'body'}
+        self._responses = responses or {}
+        # Page URLs include the dates scraped, so a replay has to start from the same day
+        self.first_date = first_date
+
+    def __len__(self):
+        return len(self._responses)
+
+    def record(self, url, status, reason, headers, body):
+        response = {
+            'status': status,
+            'reason': reason,
+            'headers': [[name, headers[name]] for name in CASSETTE_HEADERS if headers.get(name) is not None],
+            'body': body.decode('utf-8', 'surrogateescape'),
+        }
+        with self._lock:
+            self._responses[get_cassette_key(url)] = response
+
+    #
+    # returns:  (status, reason, list of [header name, value], body bytes) recorded for url, or None
+    #
+    def lookup(self, url):
+        with self._lock:
+            response = self._responses.get(get_cassette_key(url))
+        if response is None:
+            return None
+        return (response['status'], response['reason'], response['headers'],
+                response['body'].encode('utf-8', 'surrogateescape'))
+
+    def save(self, path):
+        with self._lock:
+            responses = dict(self._responses)
+        # Write then rename, so an interrupted save doesn't destroy the previous cassette
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as cassette_file:
+            json.dump({'version': CASSETTE_VERSION, 'recorded': timezone.now().isoformat(),
+                       'first_date': self.first_date.isoformat() if self.first_date else None,
+                       'responses': responses}, cassette_file)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as cassette_file:
+            contents = json.load(cassette_file)
+        if contents.get('version') != CASSETTE_VERSION:
+            raise ValueError("Unsupported cassette version {} in {}".format(contents.get('version'), path))
+        first_date = datetime.fromisoformat(contents['first_date']) if contents.get('first_date') else None
+        return cls(contents['responses'], first_date)
+
+
+#
+# Local stand-in for every site in a cassette
+#
+# Requests for http://127.0.0.1:<port>/<scheme>/<host>/<path> are answered with the response recorded for
+# <scheme>://<host>/<path> (see get_replay_url), after latency seconds.  Validators are honored, so conditional
+# requests get a 304 when they match the recorded ETag / Last-Modified.  URLs missing from the cassette get a 404.
+#
+class ReplayServer:
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_GET(self):
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            url = get_recorded_url(self.path)
+            response = self.server.cassette.lookup(url) if url else None
+            if response is None:
+                logger.warning("REPLAY:  NO RECORDED RESPONSE FOR {}".format(url or self.path))
+                self.send_error(404)
+                return
+            status, reason, headers, body = response
+            etag = dict(headers).get('ETag') or '"{}"'.format(hashlib.sha1(body).hexdigest())
+            last_modified = dict(headers).get('Last-Modified')
+            if status == 200 and (self.headers.get('If-None-Match') == etag or
+                                  (last_modified and self.headers.get('If-Modified-Since') == last_modified)):
+                self.send_response(304, "Not Modified")
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(status, reason)
+            for name, value in headers:
+                if name != 'ETag':
+                    self.send_header(name, value)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        # Room for a full scrape's worth of concurrent connects from the asyncio engine
+        request_queue_size = 1024
+
+    def __init__(self, cassette, latency=0):
+        self._server = self.Server(('127.0.0.1', 0), self.Handler)
+        self._server.cassette = cassette
+        self._server.latency = latency
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05},
+                                        daemon=True)
+
+    @property
+    def address(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Recorded URLs are looked up without fragments, and with "/" for an empty path (as requested on the wire)
+def get_cassette_key(url):
+    parts = urlsplit(url)
+    return "{}://{}{}{}".format(parts.scheme, parts.netloc, parts.path or '/',
+                                '?' + parts.query if parts.query else '')
+
+
+# https://widgets.healcode.com/widgets/... -> <replay server>/https/widgets.healcode.com/widgets/...
+def get_replay_url(address, url):
+    parts = urlsplit(url)
+    return "{}/{}/{}{}{}".format(address, parts.scheme, quote(parts.netloc, safe=':'), parts.path or '/',
+                                 '?' + parts.query if parts.query else '')
+
+
+# Inverse of get_replay_url, from the request target the replay server received
+def get_recorded_url(target):
+    # FORMAT:  /<scheme>/<host>[:<port>]/<path>[?<query>]
+    parts = target.split('/', 3)
+    if len(parts) < 3 or parts[1] not in ('http', 'https'):
+        return None
+    return "{}://{}/{}".format(parts[1], unquote(parts[2]), parts[3] if len(parts) > 3 else '')
+
+
+#
+# Record / replay state for the fetch layer (see fetch.py)
+#
+# While recording, every response the scraper receives (redirects and errors included) is added to the cassette.
+# While replaying, requests are sent to a ReplayServer instead of the real sites.
+#
+class HttpCassette:
+
+    def __init__(self):
+        self._recording = None
+        self._replay_server = None
+        # Cassette being recorded or replayed
+        self._active = None
+
+    @property
+    def recording(self):
+        return self._recording is not None
+
+    def record(self, url, status, reason, headers, body):
+        if self._recording is not None:
+            self._recording.record(url, status, reason, headers, body)
+
+    #
+    # returns:  URL to actually connect to for url
+    #
+    def get_transport_url(self, url):
+        if self._replay_server is None:
+            return url
+        return get_replay_url(self._replay_server.address, url)
+
+    #
+    # Record every response into a new cassette, saved to path on exit (even if the scrape failed)
+    #
+    @contextmanager
+    def use_recording(self, path):
+        self._recording = self._active = cassette = Cassette()
+        try:
+            yield cassette
+        finally:
+            self._recording = self._active = None
+            cassette.save(path)
+            logger.info("CASSETTE:  RECORDED {} RESPONSES TO {}".format(len(cassette), path))
+
+    #
+    # Serve every request from the cassette at path, latency seconds per response
+    #
+    @contextmanager
+    def use_replay(self, path, latency=0):
+        cassette = Cassette.load(path)
+        replay_server = ReplayServer(cassette, latency)
+        replay_server.start()
+        self._replay_server = replay_server
+        self._active = cassette
+        try:
+            yield cassette
+        finally:
+            self._replay_server = self._active = None
+            replay_server.stop()
+
+    #
+    # Context for a scrape:  recording or replaying if mode is set (default:  settings.SCRAPER_CASSETTE_MODE),
+    # otherwise live.  Nested in another use_cassette(), keeps to the cassette already in use.
+    #
+    # yields:  the Cassette recorded or replayed, None if live
+    #
+    @contextmanager
+    def use_cassette(self, mode=None, path=None, latency=None):
+        mode = mode or getattr(settings, 'SCRAPER_CASSETTE_MODE', None)
+        path = path or getattr(settings, 'SCRAPER_CASSETTE_PATH', None)
+        latency = latency if latency is not None else getattr(settings, 'SCRAPER_REPLAY_LATENCY', 0)
+        if mode is None or self._active is not None:
+            yield self._active
+            return
+        if mode not in (CASSETTE_MODE_RECORD, CASSETTE_MODE_REPLAY):
+            raise ValueError("Unknown cassette mode: {}".format(mode))
+        if not path:
+            raise ValueError("A cassette path is needed to {}".format(mode))
+        cassette_context = self.use_recording(path) if mode == CASSETTE_MODE_RECORD else \
+            self.use_replay(path, latency)
+        with cassette_context as cassette:
+            yield cassette
+
+
+HTTP_CASSETTE = HttpCassette()
@@ -0,0 +1,540 @@
+from django.conf import settings
+
+from contextlib import contextmanager
+from http.client import parse_headers, HTTPConnection, HTTPSConnection, HTTPException
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+
+from .cassette import HTTP_CASSETTE
+from .metrics import SCRAPE_METRICS
+
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+
+logger = logging.getLogger('django')
+
+
+# *** Constants ***
+
+DEFAULT_FETCH_TIMEOUT = 30
+DEFAULT_MAX_IN_FLIGHT = 200
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_IDLE_TIMEOUT = 30
+# Bytes per read for fetch_chunks
+DEFAULT_CHUNK_SIZE = 16 * 1024
+
+
+def get_fetch_timeout():
+    return getattr(settings, 'SCRAPER_FETCH_TIMEOUT', DEFAULT_FETCH_TIMEOUT)
+
+
+#
+# Counters for conditional requests, safe to update from worker threads
+#
+class HttpCacheStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.not_modified = 0
+            self.bytes_fetched = 0
+            self.bytes_saved = 0
+
+    def record(self, not_modified, size):
+        with self._lock:
+            self.requests += 1
+            if not_modified:
+                self.not_modified += 1
+                self.bytes_saved += size
+            else:
+                self.bytes_fetched += size
+
+    @property
+    def hit_ratio(self):
+        return self.not_modified / self.requests if self.requests else 0.0
+
+    def __str__(self):
+        return "REQUESTS:  {}, NOT MODIFIED:  {}, HIT RATIO:  {:.2f}, BYTES FETCHED:  {}, BYTES SAVED:  {}".format(
+            self.requests, self.not_modified, self.hit_ratio, self.bytes_fetched, self.bytes_saved)
+
+
+#
+# On-disk store of HTTP validators (ETag / Last-Modified) for conditional requests
+#
+# One small JSON file per URL in settings.SCRAPER_HTTP_CACHE_DIR (None disables the cache).  Only validators
+# and the body size are kept:  a 304 means the page is unchanged since it was last fetched, so callers skip it
+# rather than re-parse a stored copy.  The validators don't know whether what was parsed from the page is still
+# stored, so callers only fetch conditionally when they know it is (see models.PageHashCache.is_stored).
+#
+# Entries written during a run are remembered, so abort_run() can drop them if the run fails before the
+# pages were stored; otherwise the next run would skip pages that were never saved.
+#
+class HttpCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._run_urls = set()
+        self.stats = HttpCacheStats()
+
+    @property
+    def directory(self):
+        return getattr(settings, 'SCRAPER_HTTP_CACHE_DIR', None)
+
+    def begin_run(self):
+        with self._lock:
+            self._run_urls = set()
+        self.stats.reset()
+
+    def abort_run(self):
+        with self._lock:
+            run_urls, self._run_urls = self._run_urls, set()
+        for url in run_urls:
+            self.invalidate(url)
+
+    #
+    # returns:  request headers validating the cached copy of url (empty if there's none)
+    #
+    def get_validators(self, url):
+        entry = self._read(url)
+        validators = {}
+        if entry and entry.get('etag'):
+            validators['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            validators['If-Modified-Since'] = entry['last_modified']
+        return validators
+
+    def store(self, url, response_headers, size):
+        self.stats.record(False, size)
+        if not self.directory or not (response_headers.get('ETag') or response_headers.get('Last-Modified')):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(url)
+        # Write then rename, so concurrent readers never see a partial file
+        with open(path + '.tmp.' + str(threading.get_ident()), 'w') as entry_file:
+            json.dump({'url': url, 'etag': response_headers.get('ETag'),
+                       'last_modified': response_headers.get('Last-Modified'), 'size': size}, entry_file)
+        os.replace(entry_file.name, path)
+        with self._lock:
+            self._run_urls.add(url)
+
+    def record_not_modified(self, url):
+        entry = self._read(url)
+        self.stats.record(True, entry.get('size', 0) if entry else 0)
+
+    def invalidate(self, url):
+        if self.directory:
+            try:
+                os.remove(self._get_path(url))
+            except FileNotFoundError:
+                pass
+
+    def _read(self, url):
+        if not self.directory:
+            return None
+        try:
+            with open(self._get_path(url)) as entry_file:
+                return json.load(entry_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _get_path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+HTTP_CACHE = HttpCache()
+
+
+#
+# Per-host pool of keep-alive connections for the blocking fetch path
+#
+# Connections are checked out for one request at a time, so the pool is safe to share between worker
+# threads.  Up to max_size idle connections are kept per (scheme, host, port); idle connections older than
+# idle_timeout seconds are closed instead of reused.  A reused connection the server has since dropped is
+# retried once on a fresh one.
+#
+class ConnectionPool:
+
+    def __init__(self, max_size=None, idle_timeout=None):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (scheme, host, port) -> list of (connection, time released)
+        self._idle = {}
+        self.connections_opened = 0
+
+    @property
+    def max_size(self):
+        return self._max_size or getattr(settings, 'SCRAPER_POOL_SIZE', DEFAULT_POOL_SIZE)
+
+    @property
+    def idle_timeout(self):
+        return self._idle_timeout or getattr(settings, 'SCRAPER_POOL_IDLE_TIMEOUT', DEFAULT_POOL_IDLE_TIMEOUT)
+
+    #
+    # returns:  (status, reason, headers, body)
+    #
+    def request(self, url, headers):
+        with self.open(url, headers) as response:
+            body = response.read()
+        return response.status, response.reason, response.headers, body
+
+    #
+    # Context manager for a response whose body is read by the caller, e.g. in chunks with response.read(size)
+    #
+    # The connection goes back to the pool only if the body was read to the end; otherwise it's closed.
+    #
+    @contextmanager
+    def open(self, url, headers):
+        url = HTTP_CASSETTE.get_transport_url(url)
+        key = get_host_key(urlsplit(url))
+        connection, response = self._send(key, url, headers)
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close or not response.isclosed():
+            connection.close()
+        else:
+            self._release(key, connection)
+
+    def _send(self, key, url, headers):
+        connection, reused = self._acquire(key)
+        try:
+            connection.request('GET', get_request_target(urlsplit(url)), headers=get_request_headers(headers))
+            return connection, connection.getresponse()
+        except (HTTPException, ConnectionError):
+            connection.close()
+            if not reused:
+                raise
+            return self._send(key, url, headers)
+        except Exception:
+            connection.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, released in connections:
+                connection.close()
+
+    def _acquire(self, key):
+        expired = []
+        connection = None
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                candidate, released = connections.pop()
+                if time.monotonic() - released < self.idle_timeout:
+                    connection = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if connection is not None:
+            return connection, True
+
+        scheme, host, port = key
+        connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        with self._lock:
+            self.connections_opened += 1
+        return connection_class(host, port, timeout=get_fetch_timeout()), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_size:
+                connections.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+
+HTTP_POOL = ConnectionPool()
+
+
+#
+# Blocking fetch, returns the response body
+#
+# params:
+# url:  page to retrieve
+# headers:  extra request headers (dict)
+# conditional:  validate against HTTP_CACHE; returns None if the page is unchanged (304)
+# store_validators:  keep the response's validators in HTTP_CACHE for later conditional requests (default:
+# conditional)
+#
+def fetch(url, headers=None, conditional=False, store_validators=None):
+    request_headers = get_fetch_headers(url, headers, conditional)
+    request_url = url
+    for _ in range(MAX_REDIRECTS + 1):
+        with SCRAPE_METRICS.time('fetch'):
+            status, reason, response_headers, body = HTTP_POOL.request(request_url, request_headers)
+        HTTP_CASSETTE.record(request_url, status, reason, response_headers, body)
+        if status in REDIRECT_STATUSES and response_headers.get('Location'):
+            request_url = urljoin(request_url, response_headers['Location'])
+            continue
+        return finish_response(url, request_url, conditional, store_validators, status, reason, response_headers,
+                               body)
+    raise HTTPError(request_url, status, "Too many redirects", response_headers, io.BytesIO(body))
+
+
+#
+# Request headers for fetch(), fetch_chunks() and AsyncFetcher.fetch()
+#
+# Validators aren't sent while recording a cassette, so every page is recorded in full.
+#
+def get_fetch_headers(url, headers, conditional):
+    request_headers = dict(headers or {})
+    if conditional and not HTTP_CASSETTE.recording:
+        request_headers.update(HTTP_CACHE.get_validators(url))
+    return request_headers
+
+
+#
+# Shared tail of fetch() and AsyncFetcher.fetch():  update HTTP_CACHE, raise HTTPError for error statuses
+#
+# returns:  response body, or None for an unchanged conditional request
+#
+def finish_response(url, request_url, conditional, store_validators, status, reason, response_headers, body):
+    SCRAPE_METRICS.add('fetch_bytes', len(body))
+    if conditional and status == 304:
+        HTTP_CACHE.record_not_modified(url)
+        return None
+    if status >= 400:
+        raise HTTPError(request_url, status, reason, response_headers, io.BytesIO(body))
+    if conditional if store_validators is None else store_validators:
+        HTTP_CACHE.store(url, response_headers, len(body))
+    return body
+
+
+#
+# Blocking fetch that yields the response body in chunks of up to chunk_size bytes as they arrive
+#
+# Same parameters and errors as fetch(); an unchanged conditional request yields nothing, an empty body one empty
+# chunk.  Validators are only stored once the whole body has been read.
+#
+def fetch_chunks(url, headers=None, conditional=False, store_validators=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    request_headers = get_fetch_headers(url, headers, conditional)
+    request_url = url
+    for _ in range(MAX_REDIRECTS + 1):
+        with HTTP_POOL.open(request_url, request_headers) as response:
+            if response.status in REDIRECT_STATUSES and response.headers.get('Location'):
+                HTTP_CASSETTE.record(request_url, response.status, response.reason, response.headers,
+                                     response.read())
+                request_url = urljoin(request_url, response.headers['Location'])
+                continue
+            if (conditional and response.status == 304) or response.status >= 400:
+                body = response.read()
+                HTTP_CASSETTE.record(request_url, response.status, response.reason, response.headers, body)
+                finish_response(url, request_url, conditional, store_validators, response.status, response.reason,
+                                response.headers, body)
+                return
+            size = 0
+            # Kept only while recording a cassette
+            recorded_chunks = [] if HTTP_CASSETTE.recording else None
+            while True:
+                # Only time spent reading counts as fetch time, the caller's work between chunks doesn't
+                read_start = time.perf_counter()
+                chunk = response.read(chunk_size)
+                SCRAPE_METRICS.observe('fetch', time.perf_counter() - read_start)
+                if not chunk:
+                    if not size:
+                        # Not nothing, or it would read as unchanged
+                        yield b''
+                    break
+                size += len(chunk)
+                if recorded_chunks is not None:
+                    recorded_chunks.append(chunk)
+                yield chunk
+            SCRAPE_METRICS.add('fetch_bytes', size)
+            if recorded_chunks is not None:
+                HTTP_CASSETTE.record(request_url, response.status, response.reason, response.headers,
+                                     b''.join(recorded_chunks))
+            if conditional if store_validators is None else store_validators:
+                HTTP_CACHE.store(url, response.headers, size)
+            return
+    raise HTTPError(request_url, response.status, "Too many redirects", response.headers, io.BytesIO(b''))
+
+
+def get_host_key(parts):
+    return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+def get_request_target(parts):
+    return (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+
+def get_request_headers(headers):
+    request_headers = {
+        'User-Agent': 'Python-urllib',
+        'Accept-Encoding': 'identity',
+    }
+    request_headers.update(headers)
+    return request_headers
+
+
+#
+# Non-blocking fetch layer for the asyncio scrape engine
+#
+# Speaks just enough HTTP/1.1 over asyncio streams to GET the scraper's pages (Content-Length, chunked and
+# read-until-close bodies, redirects), so hundreds of requests can be in flight from a single thread.
+# Errors are raised as urllib's HTTPError, same as the blocking path.
+#
+# Connections are kept alive and pooled per host, with the same size and idle timeout settings as
+# ConnectionPool.  Call close() when done to drop the idle ones.
+#
+class AsyncFetcher:
+
+    def __init__(self, max_in_flight=None, timeout=None, pool_size=None, idle_timeout=None):
+        self._max_in_flight = max_in_flight or getattr(settings, 'SCRAPER_MAX_IN_FLIGHT', DEFAULT_MAX_IN_FLIGHT)
+        self._timeout = timeout or get_fetch_timeout()
+        self._pool_size = pool_size or getattr(settings, 'SCRAPER_POOL_SIZE', DEFAULT_POOL_SIZE)
+        self._idle_timeout = idle_timeout or getattr(settings, 'SCRAPER_POOL_IDLE_TIMEOUT',
+                                                     DEFAULT_POOL_IDLE_TIMEOUT)
+        self._semaphore = None
+        self._ssl_context = None
+        # (scheme, host, port) -> list of (reader, writer, time released)
+        self._idle = {}
+        self.connections_opened = 0
+
+    #
+    # Same as the blocking fetch(), including conditional requests
+    #
+    async def fetch(self, url, headers=None, conditional=False, store_validators=None):
+        # Created lazily so the semaphore binds to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        request_headers = get_fetch_headers(url, headers, conditional)
+        async with self._semaphore:
+            request_url = url
+            for _ in range(MAX_REDIRECTS + 1):
+                with SCRAPE_METRICS.time('fetch'):
+                    status, reason, response_headers, body = await asyncio.wait_for(
+                        self._get(request_url, request_headers), self._timeout)
+                HTTP_CASSETTE.record(request_url, status, reason, response_headers, body)
+                if status in REDIRECT_STATUSES and response_headers.get('Location'):
+                    request_url = urljoin(request_url, response_headers['Location'])
+                    continue
+                return finish_response(url, request_url, conditional, store_validators, status, reason,
+                                       response_headers, body)
+            raise HTTPError(request_url, status, "Too many redirects", response_headers, io.BytesIO(body))
+
+    async def close(self):
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for reader, writer, released in connections:
+                writer.close()
+
+    async def _get(self, url, headers):
+        parts = urlsplit(HTTP_CASSETTE.get_transport_url(url))
+        key = get_host_key(parts)
+        reader, writer, reused = await self._acquire(key)
+        try:
+            writer.write(self._build_request(parts, headers))
+            await writer.drain()
+            status, reason, response_headers, body, will_close = await read_response(reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError):
+            # ValueError/IndexError:  empty status line, the server dropped an idle connection
+            writer.close()
+            if not reused:
+                raise
+            return await self._get(url, headers)
+        except BaseException:
+            writer.close()
+            raise
+        if will_close:
+            writer.close()
+        else:
+            self._release(key, reader, writer)
+        return status, reason, response_headers, body
+
+    async def _acquire(self, key):
+        connections = self._idle.get(key, [])
+        while connections:
+            reader, writer, released = connections.pop()
+            if time.monotonic() - released < self._idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+
+        scheme, host, port = key
+        self.connections_opened += 1
+        reader, writer = await asyncio.open_connection(host, port,
+                                                       ssl=self._get_ssl_context() if scheme == 'https' else None)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        connections = self._idle.setdefault(key, [])
+        if len(connections) < self._pool_size:
+            connections.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    def _get_ssl_context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    @staticmethod
+    def _build_request(parts, headers):
+        request_headers = {'Host': parts.netloc}
+        request_headers.update(get_request_headers(headers))
+        lines = ["GET {} HTTP/1.1".format(get_request_target(parts))]
+        lines.extend("{}: {}".format(name, value) for name, value in request_headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+
+#
+# Read a complete HTTP/1.1 response from an asyncio stream
+#
+# returns:  (status, reason, headers, body, will_close), will_close if the connection can't be reused
+#
+async def read_response(reader):
+    status_line = (await reader.readline()).decode('latin-1').rstrip("\r\n")
+    # FORMAT:  HTTP/1.1 200 OK
+    status_parts = status_line.split(' ', 2)
+    status = int(status_parts[1])
+    reason = status_parts[2] if len(status_parts) > 2 else ""
+
+    header_lines = []
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        header_lines.append(line)
+    headers = parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+    will_close = headers.get('Connection', '').lower() == 'close' or status_parts[0] == 'HTTP/1.0'
+
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        chunks = []
+        while True:
+            # FORMAT:  <hex size>[;extensions]\r\n<data>\r\n, terminated by a zero-size chunk and trailers
+            chunk_size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if chunk_size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(chunk_size))
+            await reader.readline()
+        body = b''.join(chunks)
+    elif headers.get('Content-Length') is not None:
+        body = await reader.readexactly(int(headers['Content-Length']))
+    elif status in (204, 304) or 100 <= status < 200:
+        body = b''
+    else:
+        # Body runs until the server closes the connection
+        body = await reader.read()
+        will_close = True
+    return status, reason, headers, body, will_close
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import models
+
+
+#
+# Move past classes out of the searched table, see models.archive_past_classes
+#
+# Also run after every successful scrape when settings.SCRAPER_ARCHIVE_AFTER_SCRAPE is set.
+#
+class Command(BaseCommand):
+    help = "Move classes older than the retention horizon to the archive table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="retention horizon in days (default:  SCRAPER_RETENTION_DAYS)")
+        parser.add_argument('--batch-size', type=int,
+                            help="rows moved per transaction (default:  SCRAPER_ARCHIVE_BATCH)")
+
+    def handle(self, *args, **options):
+
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError("--days can't be negative")
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive")
+        archived = models.archive_past_classes(options['days'], options['batch_size'])
+        self.stdout.write("ARCHIVED {} CLASSES, {} LEFT".format(archived, models.EastonClass.objects.count()))
@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+import django
+import json
+import platform
+import subprocess
+
+from ... import benchmark
+
+
+#
+# Benchmark each scrape and search stage offline, on the recorded pages in retriever/testdata
+#
+# Runs on a throwaway test database.  With --output the results are saved as JSON, with the commit they were
+# measured on; with --compare they're checked against a previous file, and any stage slower by more than
+# --tolerance fails the command.
+#
+class Command(BaseCommand):
+    help = "Benchmark the scrape and search stages on recorded pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=benchmark.DEFAULT_REPEAT,
+                            help="runs per stage, the fastest is reported")
+        parser.add_argument('--classes', type=int, default=benchmark.DEFAULT_SEARCH_CLASSES,
+                            help="classes stored for the upsert and search stages")
+        parser.add_argument('--stage', action='append', dest='stages',
+                            choices=[name for name, _ in benchmark.BENCHMARK_STAGES],
+                            help="run only this stage, may be repeated")
+        parser.add_argument('--output', help="save the results to this JSON file")
+        parser.add_argument('--compare', help="JSON file from a previous run to compare against")
+        parser.add_argument('--tolerance', type=float, default=benchmark.DEFAULT_REGRESSION_TOLERANCE,
+                            help="slowdown (fraction) of a stage reported as a regression")
+
+    def handle(self, *args, **options):
+
+        if options['repeat'] < 1 or options['classes'] < 1:
+            raise CommandError("--repeat and --classes must be positive")
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as previous_file:
+                previous = json.load(previous_file)
+
+        old_database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = benchmark.run_benchmarks(options['repeat'], options['classes'], options['stages'])
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+        for name, result in results.items():
+            self.stdout.write("{:<24}{:>14,.0f} items/s  ({} items in {:.4f}s)".format(
+                name, result['items_per_second'] or 0, result['items'], result['best_seconds']))
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({'run': get_run_info(), 'stages': results}, output_file, indent=2)
+                output_file.write("\n")
+
+        if previous is not None:
+            comparison = benchmark.compare_results(previous['stages'], results, options['tolerance'])
+            for name, previous_rate, current_rate, change, regressed in comparison:
+                self.stdout.write("{:<24}{:>+8.1%}{}".format(name, change, "  REGRESSION" if regressed else ""))
+            regressions = [name for name, _, _, _, regressed in comparison if regressed]
+            if regressions:
+                raise CommandError("Slower than {}:  {}".format(options['compare'], ", ".join(regressions)))
+
+
+# What a result was measured on, so results from different commits / machines can be told apart
+def get_run_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'html_parser': getattr(settings, 'SCRAPER_HTML_PARSER', None),
+    }
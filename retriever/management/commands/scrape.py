@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from contextlib import ExitStack
+
+from ... import models
+from ...cassette import CASSETTE_MODE_RECORD, CASSETTE_MODE_REPLAY, HTTP_CASSETTE
+
+
+#
+# Scrape every gym's calendar, same as the retrieve/ page
+#
+# --record saves every response to a cassette file; --replay scrapes from one instead of the live sites, through a
+# local stand-in server (optionally with --latency per response), so full scrapes can be profiled and load tested
+# offline.
+#
+class Command(BaseCommand):
+    help = "Scrape every gym's calendar, optionally recording or replaying the responses"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=models.NUMBER_RETRIEVAL_DAYS)
+        parser.add_argument('--engine', choices=[models.SCRAPER_ENGINE_THREADS, models.SCRAPER_ENGINE_ASYNCIO])
+        parser.add_argument('--workers', type=int)
+        parser.add_argument('--processes', type=int, help="processes pages are parsed in (threads engine)")
+        cassette_group = parser.add_mutually_exclusive_group()
+        cassette_group.add_argument('--record', metavar='CASSETTE', help="save every response to this file")
+        cassette_group.add_argument('--replay', metavar='CASSETTE', help="serve every response from this file")
+        parser.add_argument('--latency', type=float, default=None,
+                            help="seconds added to each replayed response")
+        parser.add_argument('--no-http-cache', action='store_true',
+                            help="don't send or store validators, so every page is fetched and parsed in full")
+
+    def handle(self, *args, **options):
+
+        if options['latency'] is not None and not options['replay']:
+            raise CommandError("--latency only applies to --replay")
+        with ExitStack() as stack:
+            if options['no_http_cache']:
+                stack.enter_context(override_settings(SCRAPER_HTTP_CACHE_DIR=None))
+            if options['record']:
+                stack.enter_context(HTTP_CASSETTE.use_cassette(CASSETTE_MODE_RECORD, options['record']))
+            elif options['replay']:
+                stack.enter_context(HTTP_CASSETTE.use_cassette(CASSETTE_MODE_REPLAY, options['replay'],
+                                                               options['latency']))
+            models.retrieve_data_from_web(options['days'], options['workers'], options['engine'],
+                                          processes=options['processes'])
+        self.stdout.write("HTTP CACHE:  {}".format(models.HTTP_CACHE.stats))
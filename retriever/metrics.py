@@ -0,0 +1,149 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+import threading
+import time
+
+
+# *** Constants ***
+
+METRIC_PREFIX = "scraper"
+# Label for work not tied to one gym
+ALL_GYMS = "all"
+
+# Gym whose pages the current thread / asyncio task is working on, see gym_label()
+CURRENT_GYM = ContextVar('scraper_current_gym', default=ALL_GYMS)
+
+
+#
+# Counters and stage timings for scrape runs, labeled by gym
+#
+# Safe to update from worker threads and asyncio tasks.  Stages used by the scraper:
+# fetch:  one HTTP request, from sending it to reading the whole body (plus counter fetch_bytes)
+# parse:  building classes from one page, including classify (in parse processes:  the wait for the worker's result)
+# classify:  classify_classes for one page's classes (a week's for zencalendar, a chunk's when streaming)
+# upsert:  one bulk_upsert batch (plus counters rows_inserted, rows_updated)
+# run:  one retrieve_data_from_web call (plus counters runs, run_failures)
+#
+# render() returns everything in the Prometheus text format, see views.get_metrics.
+#
+class ScrapeMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (name, gym) -> value
+            self._counters = {}
+            # (stage, gym) -> [count, total seconds, max seconds]
+            self._timings = {}
+            # name -> value
+            self._gauges = {}
+
+    def add(self, name, value=1, gym=None):
+        key = (name, gym or CURRENT_GYM.get())
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, stage, seconds, gym=None):
+        key = (stage, gym or CURRENT_GYM.get())
+        with self._lock:
+            timing = self._timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    @contextmanager
+    def time(self, stage, gym=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, gym)
+
+    #
+    # returns:  counter value for gym, or summed over every gym if gym is None
+    #
+    def get_counter(self, name, gym=None):
+        with self._lock:
+            return sum(value for (counter_name, counter_gym), value in self._counters.items()
+                       if counter_name == name and gym in (None, counter_gym))
+
+    #
+    # returns:  (count, total seconds) recorded for stage and gym, or summed over every gym if gym is None
+    #
+    def get_timing(self, stage, gym=None):
+        with self._lock:
+            timings = [timing for (timing_stage, timing_gym), timing in self._timings.items()
+                       if timing_stage == stage and gym in (None, timing_gym)]
+        return sum(timing[0] for timing in timings), sum(timing[1] for timing in timings)
+
+    #
+    # params:
+    # extra_gauges:  dict of name -> value to include, e.g. cache statistics owned by other modules
+    #
+    def render(self, extra_gauges=None):
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {key: list(timing) for key, timing in self._timings.items()}
+            gauges = dict(self._gauges)
+        gauges.update(extra_gauges or {})
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append("# TYPE {}_{}_total counter".format(METRIC_PREFIX, name))
+            for (counter_name, gym), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append('{}_{}_total{{gym="{}"}} {}'.format(METRIC_PREFIX, name, gym, value))
+        if timings:
+            lines.append("# TYPE {}_stage_seconds summary".format(METRIC_PREFIX))
+            for (stage, gym), (count, total, _) in sorted(timings.items()):
+                labels = '{{stage="{}",gym="{}"}}'.format(stage, gym)
+                lines.append("{}_stage_seconds_count{} {}".format(METRIC_PREFIX, labels, count))
+                lines.append("{}_stage_seconds_sum{} {:.6f}".format(METRIC_PREFIX, labels, total))
+            lines.append("# TYPE {}_stage_seconds_max gauge".format(METRIC_PREFIX))
+            for (stage, gym), (_, _, longest) in sorted(timings.items()):
+                lines.append('{}_stage_seconds_max{{stage="{}",gym="{}"}} {:.6f}'.format(
+                    METRIC_PREFIX, stage, gym, longest))
+        for name, value in sorted(gauges.items()):
+            lines.append("# TYPE {}_{} gauge".format(METRIC_PREFIX, name))
+            lines.append("{}_{} {}".format(METRIC_PREFIX, name, value))
+        return "\n".join(lines) + "\n"
+
+
+SCRAPE_METRICS = ScrapeMetrics()
+
+
+# Decorator recording each call of the function as one observation of stage
+def timed(stage):
+    def decorator(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with SCRAPE_METRICS.time(stage):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+#
+# Label metrics recorded in this thread / asyncio task (and tasks it starts) with gym
+#
+@contextmanager
+def gym_label(gym):
+    token = CURRENT_GYM.set(get_gym_label(gym))
+    try:
+        yield
+    finally:
+        CURRENT_GYM.reset(token)
+
+
+# EastonGym.AR -> "AR"
+def get_gym_label(gym):
+    return getattr(gym, 'name', None) or str(gym).split('.')[-1]
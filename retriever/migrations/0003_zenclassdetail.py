@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:48
+
+from django.db import migrations, models
+import retriever.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0002_auto_20190310_0320'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZenClassDetail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gym', models.CharField(choices=[(retriever.models.EastonGym('Arvada'), 'Arvada'), (retriever.models.EastonGym('Aurora'), 'Aurora'), (retriever.models.EastonGym('Boulder'), 'Boulder'), (retriever.models.EastonGym('Castle Rock'), 'Castle Rock'), (retriever.models.EastonGym('Centennial'), 'Centennial'), (retriever.models.EastonGym('Denver'), 'Denver'), (retriever.models.EastonGym('Littleton'), 'Littleton'), (retriever.models.EastonGym('Thornton'), 'Thornton')], max_length=2)),
+                ('appointment_id', models.CharField(max_length=255)),
+                ('listing_hash', models.CharField(max_length=40)),
+                ('class_time', models.CharField(max_length=255)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('gym', 'appointment_id')},
+            },
+        ),
+    ]
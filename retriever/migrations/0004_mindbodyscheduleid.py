@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:49
+
+from django.db import migrations, models
+import retriever.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0003_zenclassdetail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MindBodyScheduleId',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gym', models.CharField(choices=[(retriever.models.EastonGym('Arvada'), 'Arvada'), (retriever.models.EastonGym('Aurora'), 'Aurora'), (retriever.models.EastonGym('Boulder'), 'Boulder'), (retriever.models.EastonGym('Castle Rock'), 'Castle Rock'), (retriever.models.EastonGym('Centennial'), 'Centennial'), (retriever.models.EastonGym('Denver'), 'Denver'), (retriever.models.EastonGym('Littleton'), 'Littleton'), (retriever.models.EastonGym('Thornton'), 'Thornton')], max_length=2, unique=True)),
+                ('schedule_id', models.CharField(max_length=255)),
+                ('resolved_at', models.DateTimeField()),
+            ],
+        ),
+    ]
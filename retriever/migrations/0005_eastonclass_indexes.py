@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:56
+
+from django.db import migrations, models
+
+
+# Rows saved before (gym, class_id) was unique may repeat a class, keep the most recently inserted one
+def delete_duplicate_classes(apps, schema_editor):
+    EastonClass = apps.get_model('retriever', 'EastonClass')
+    duplicates = EastonClass.objects.values('gym', 'class_id') \
+        .annotate(latest_id=models.Max('id'), rows=models.Count('id')).filter(rows__gt=1)
+    for duplicate in duplicates:
+        EastonClass.objects.filter(gym=duplicate['gym'], class_id=duplicate['class_id']) \
+            .exclude(id=duplicate['latest_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0004_mindbodyscheduleid'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_classes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='eastonclass',
+            unique_together={('gym', 'class_id')},
+        ),
+        migrations.AddIndex(
+            model_name='eastonclass',
+            index=models.Index(fields=['gym', 'category', 'requirements', 'start_time'], name='eastonclass_search_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+import retriever.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0005_eastonclass_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='queued', max_length=10)),
+                ('number_of_days', models.IntegerField()),
+                ('requested_at', models.DateTimeField()),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('batches_total', models.IntegerField(default=0)),
+                ('batches_done', models.IntegerField(default=0)),
+                ('classes_stored', models.IntegerField(default=0)),
+                ('skipped_gyms', models.CharField(blank=True, max_length=255)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScrapeLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gym', models.CharField(choices=[(retriever.models.EastonGym('Arvada'), 'Arvada'), (retriever.models.EastonGym('Aurora'), 'Aurora'), (retriever.models.EastonGym('Boulder'), 'Boulder'), (retriever.models.EastonGym('Castle Rock'), 'Castle Rock'), (retriever.models.EastonGym('Centennial'), 'Centennial'), (retriever.models.EastonGym('Denver'), 'Denver'), (retriever.models.EastonGym('Littleton'), 'Littleton'), (retriever.models.EastonGym('Thornton'), 'Thornton')], max_length=2, unique=True)),
+                ('expires_at', models.DateTimeField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='retriever.ScrapeJob')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:19
+
+from django.db import migrations, models
+import retriever.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0006_scrapejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapedPage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gym', models.CharField(choices=[(retriever.models.EastonGym('Arvada'), 'Arvada'), (retriever.models.EastonGym('Aurora'), 'Aurora'), (retriever.models.EastonGym('Boulder'), 'Boulder'), (retriever.models.EastonGym('Castle Rock'), 'Castle Rock'), (retriever.models.EastonGym('Centennial'), 'Centennial'), (retriever.models.EastonGym('Denver'), 'Denver'), (retriever.models.EastonGym('Littleton'), 'Littleton'), (retriever.models.EastonGym('Thornton'), 'Thornton')], max_length=2)),
+                ('first_date', models.DateField()),
+                ('last_date', models.DateField()),
+                ('content_hash', models.CharField(max_length=40)),
+                ('class_count', models.IntegerField()),
+                ('scraped_at', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('gym', 'first_date')},
+            },
+        ),
+    ]
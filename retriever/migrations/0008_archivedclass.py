@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0007_scrapedpage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedClass',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gym', models.CharField(max_length=2)),
+                ('category', models.CharField(max_length=3)),
+                ('class_id', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=255)),
+                ('requirements', models.CharField(max_length=3)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('canceled', models.BooleanField(default=False)),
+                ('archived_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0009_scheduleversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scrapedpage',
+            name='rules_hash',
+            field=models.CharField(default='', max_length=40),
+        ),
+    ]
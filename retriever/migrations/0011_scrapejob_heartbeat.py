@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retriever', '0010_scrapedpage_rules_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scrapejob',
+            name='heartbeat_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,13 +1,34 @@
-from django.db import models
-
-from bs4 import BeautifulSoup
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from bs4 import BeautifulSoup, SoupStrainer
+from collections import namedtuple
+from functools import lru_cache
+from html.parser import HTMLParser
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from enum import Enum
 from datetime import datetime, timedelta
-from urllib.request import urlopen, Request
-
+from urllib.error import HTTPError
+
+from .cassette import HTTP_CASSETTE
+from .fetch import fetch, fetch_chunks, AsyncFetcher, HTTP_CACHE, HTTP_POOL
+from .metrics import SCRAPE_METRICS, gym_label, get_gym_label, timed
+from .parsepool import PARSE_POOL, chain_future
+
+import asyncio
+import codecs
+import hashlib
+import itertools
+import linecache
 import logging
 import pytz
 import re
+import threading
+import time
+import uuid
 
 logger = logging.getLogger('django')
 
@@ -113,6 +134,48 @@ LAST_UPDATE_TIME = datetime.now(pytz.timezone('US/Mountain'))
 CALENDAR_LINK_GYM_IDX = 0
 CALENDAR_LINK_TYPE_IDX = 1;
 CALENDAR_LINK_URL_IDX = 2;
+
+DEFAULT_SCRAPER_WORKERS = 8
+# Worker processes the threaded engine parses pages in, 0 parses on the fetch threads
+DEFAULT_PARSE_PROCESSES = 0
+# Pages queued for (or being parsed by) those processes before fetch workers wait, default:  twice the processes
+DEFAULT_PARSE_QUEUE_SIZE = None
+SCRAPER_ENGINE_THREADS = "threads"
+SCRAPER_ENGINE_ASYNCIO = "asyncio"
+DEFAULT_ZEN_DETAIL_CACHE_TTL = 7 * 24 * 60 * 60
+DEFAULT_ZEN_DETAIL_CACHE_SIZE = 10000
+DEFAULT_SCHEDULE_ID_TTL = 7 * 24 * 60 * 60
+# Seconds before a gym's ScrapeLock is taken to be abandoned
+DEFAULT_SCRAPE_LOCK_TTL = 60 * 60
+# Classes that started more than this many days ago are moved to ArchivedClass, this many at a time
+DEFAULT_RETENTION_DAYS = 14
+DEFAULT_ARCHIVE_BATCH = 500
+# Part of every page hash (see PageHashCache), change it when parsing changes so every page is parsed again
+PAGE_HASH_VERSION = 1
+# Scraped fields copied onto an existing EastonClass row by bulk_upsert (a scraped class is never canceled, so a
+# canceled class that's listed again is restored)
+UPSERT_FIELDS = ['gym', 'name', 'start_time', 'end_time', 'requirements', 'category', 'canceled']
+UPSERT_LOOKUP_CHUNK = 400
+UPSERT_WRITE_BATCH = 100
+DEFAULT_CLASSIFICATION_CACHE_SIZE = 4096
+# File name the generated classify function (see ClassClassifier) is compiled under
+CLASS_RULES_FILE_NAME = '<class rules>'
+# Primary key of the single ScheduleVersion row
+SCHEDULE_VERSION_ID = 1
+
+EASTON_REQUEST_HEADERS = {'User-Agent': "lmccrone"}
+MINDBODY_WIDGET_URL = "https://widgets.healcode.com/widgets/schedules/{}/print"
+
+# Parser given to BeautifulSoup ("html.parser", "lxml", "html5lib"), see settings.SCRAPER_HTML_PARSER
+DEFAULT_HTML_PARSER = "html.parser"
+# Only the tags each page is read for are parsed into a tree (unless settings.SCRAPER_HTML_STRAINERS is False):
+# MindBody print view and zencalendar class info rows, zencalendar day columns, and the Easton schedule page widget
+TABLE_ROW_STRAINER = SoupStrainer('tr')
+CALENDAR_DAY_STRAINER = SoupStrainer('div', attrs={'date': True})
+SCHEDULE_ID_STRAINER = SoupStrainer('healcode-widget')
+
+# One class as listed on a zencalendar week page (the class time is only on its info page)
+ZenCalendarItem = namedtuple('ZenCalendarItem', ['class_id', 'class_link_query', 'category', 'name'])
 CALENDAR_LINK_LIST = [
     [EastonGym.AR, EastonCalendarType.M, "https://eastonbjj.com/arvada/schedule"],
     [EastonGym.AU, EastonCalendarType.M, "https://eastonbjj.com/aurora/schedule"],
@@ -154,10 +217,160 @@ class EastonClass(models.Model):
     # Non-db field
     mindbody_category = None
 
+    class Meta:
+        unique_together = ('gym', 'class_id')
+        indexes = [
+            # get_classes filters, then orders by start time
+            models.Index(fields=['gym', 'category', 'requirements', 'start_time'], name='eastonclass_search_idx'),
+        ]
+
     def __str__(self):
         return "GYM:  {}, NAME:  {}, START:  {}, END:  {}".format(self.gym, self.name, self.start_time, self.end_time)
 
 
+#
+# Past EastonClass row, moved out of the searched table by archive_past_classes
+#
+# No indexes or constraints beyond the primary key, archived classes are only ever read back in bulk.
+#
+class ArchivedClass(models.Model):
+    gym = models.CharField(max_length=2)
+    category = models.CharField(max_length=3)
+    class_id = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    requirements = models.CharField(max_length=3)
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    canceled = models.BooleanField(default=False)
+    archived_at = models.DateTimeField()
+
+
+#
+# Class time read from a zencalendar class info page (enrollment.cfm?appointmentId=<id>)
+#
+# The calendar listing doesn't include class times, so every listed class needs its own info page fetch.
+# The time is kept here, along with a hash of the listing it was read for, so the fetch can be skipped while
+# the listing is unchanged.  See ZenClassDetailCache.
+#
+class ZenClassDetail(models.Model):
+    gym = models.CharField(
+        max_length=2,
+        choices=[(e, e.value) for e in EastonGym]
+    )
+    appointment_id = models.CharField(max_length=255)
+    listing_hash = models.CharField(max_length=40)
+    class_time = models.CharField(max_length=255)
+    fetched_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('gym', 'appointment_id')
+
+
+#
+# MindBody schedule ID embedded in a gym's Easton schedule page (healcode-widget data-widget-id)
+#
+# Resolving it means fetching and parsing the whole schedule page, and it rarely changes, so it's kept here
+# and re-resolved only when it expires or the widget endpoint rejects it.  See MindBodyScheduleIdCache.
+#
+class MindBodyScheduleId(models.Model):
+    gym = models.CharField(
+        max_length=2,
+        choices=[(e, e.value) for e in EastonGym],
+        unique=True
+    )
+    schedule_id = models.CharField(max_length=255)
+    resolved_at = models.DateTimeField()
+
+
+#
+# Hash of a scraped page (a MindBody day or a zencalendar week), and how many classes were stored from it
+#
+# While a page's hash is unchanged it isn't parsed again, see PageHashCache.
+#
+class ScrapedPage(models.Model):
+    gym = models.CharField(
+        max_length=2,
+        choices=[(e, e.value) for e in EastonGym]
+    )
+    first_date = models.DateField()
+    last_date = models.DateField()
+    content_hash = models.CharField(max_length=40)
+    # PageHashCache rules hash the page was parsed with, so a page isn't fetched conditionally after rule changes
+    rules_hash = models.CharField(max_length=40, default='')
+    class_count = models.IntegerField()
+    scraped_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('gym', 'first_date')
+
+
+#
+# Schedule version stamp, see get_schedule_version.  One row, SCHEDULE_VERSION_ID.
+#
+class ScheduleVersion(models.Model):
+    version = models.CharField(max_length=32)
+    updated_at = models.DateTimeField()
+
+
+#
+# One background scrape, see start_scrape_job
+#
+# Also tracks the scrape's progress for the status page:  batches are MindBody days and zencalendar weeks, one
+# bulk_upsert each.
+#
+class ScrapeJob(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    status = models.CharField(
+        max_length=10,
+        choices=[(status, status) for status in (QUEUED, RUNNING, SUCCEEDED, FAILED)],
+        default=QUEUED
+    )
+    number_of_days = models.IntegerField()
+    requested_at = models.DateTimeField()
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    # Last sign of life from the thread running the job, see fail_stale_scrape_jobs
+    heartbeat_at = models.DateTimeField(null=True)
+    batches_total = models.IntegerField(default=0)
+    batches_done = models.IntegerField(default=0)
+    classes_stored = models.IntegerField(default=0)
+    # Comma-separated gyms left out because another job was scraping them
+    skipped_gyms = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+
+    # Called by the scrape engines (on the thread running the scrape)
+    def begin(self, batches_total):
+        self.batches_total = batches_total
+        self.save(update_fields=['batches_total'])
+
+    def batch_stored(self, classes_stored):
+        now = timezone.now()
+        ScrapeJob.objects.filter(pk=self.pk).update(batches_done=models.F('batches_done') + 1,
+                                                    classes_stored=models.F('classes_stored') + classes_stored,
+                                                    heartbeat_at=now)
+        # Still scraping, so the gyms' locks aren't abandoned
+        ScrapeLock.objects.filter(job_id=self.pk).update(expires_at=now + timedelta(seconds=get_scrape_lock_ttl()))
+
+
+#
+# Held by the ScrapeJob scraping a gym, so two jobs (in any process) never scrape the same gym at once
+#
+# A lock past expires_at is taken to belong to a job that died without releasing it.  See acquire_scrape_lock.
+#
+class ScrapeLock(models.Model):
+    gym = models.CharField(
+        max_length=2,
+        choices=[(e, e.value) for e in EastonGym],
+        unique=True
+    )
+    job = models.ForeignKey(ScrapeJob, on_delete=models.CASCADE)
+    expires_at = models.DateTimeField()
+
+
 class EastonBjjClass(models.Model):
     easton_class = models.ForeignKey(EastonClass, on_delete=models.CASCADE)
     attire = models.CharField(
@@ -178,22 +391,442 @@ class EastonStrkClass(models.Model):
     )
 
 
-def retrieve_data_from_web(number_of_days):
+#
+# Scrape every gym's calendar and store the classes found
+#
+# Gyms and the days within each gym are fetched and parsed concurrently, so a full refresh takes about as long
+# as the slowest gym.  Two engines are available:
+#   "threads":  fetch on a thread pool, one blocking request per worker; pages are parsed on the same threads, or
+#       queued for a pool of worker processes (see parsepool.ParsePool) so parsing runs on every core, alongside
+#       the fetches
+#   "asyncio":  fetch on a single-threaded event loop, many requests in flight at once (see fetch.AsyncFetcher)
+# Either way, workers only fetch and parse; all database writes happen on the calling thread, as each day's
+# results come in.
+#
+# params:
+# number_of_days:  number of days to retrieve, starting today
+# workers:  size of the fetch/parse thread pool (default:  settings.SCRAPER_WORKERS)
+# engine:  "threads" or "asyncio" (default:  settings.SCRAPER_ENGINE)
+# calendar_list:  gyms to scrape, entries of CALENDAR_LINK_LIST (default:  all of them)
+# progress:  optional ScrapeJob, told about each batch as it's stored
+# processes:  parse processes for the "threads" engine (default:  settings.SCRAPER_PARSE_PROCESSES)
+#
+def retrieve_data_from_web(number_of_days, workers=None, engine=None, calendar_list=None, progress=None,
+                           processes=None):
 
     current_time = datetime.now(pytz.timezone('US/Mountain'))
+    engine = engine or getattr(settings, 'SCRAPER_ENGINE', SCRAPER_ENGINE_THREADS)
+
+    calendar_list = CALENDAR_LINK_LIST if calendar_list is None else calendar_list
+    if engine not in (SCRAPER_ENGINE_ASYNCIO, SCRAPER_ENGINE_THREADS):
+        raise ValueError("Unknown scraper engine: {}".format(engine))
+
+    HTTP_CACHE.begin_run()
+    run_start = time.perf_counter()
+    SCRAPE_METRICS.add('runs')
+    try:
+        with SCRAPE_METRICS.time('run'), HTTP_CASSETTE.use_cassette() as cassette:
+            if cassette is not None:
+                # A replay asks for the days that were recorded, a recording notes which days those are
+                current_time = cassette.first_date or current_time
+                cassette.first_date = current_time
+            if progress is not None:
+                progress.begin(count_scrape_batches(calendar_list, current_time, number_of_days))
+            if engine == SCRAPER_ENGINE_ASYNCIO:
+                asyncio.run(retrieve_data_async(calendar_list, current_time, number_of_days, progress=progress))
+            else:
+                retrieve_data_threaded(calendar_list, current_time, number_of_days, workers, progress, processes)
+    except Exception:
+        # Pages fetched this run may not have been stored, don't let the next run skip them
+        HTTP_CACHE.abort_run()
+        SCRAPE_METRICS.add('run_failures')
+        raise
+    else:
+        if getattr(settings, 'SCRAPER_ARCHIVE_AFTER_SCRAPE', False):
+            archive_past_classes()
+    finally:
+        SCRAPE_METRICS.set_gauge('last_run_timestamp_seconds', int(time.time()))
+        SCRAPE_METRICS.set_gauge('last_run_duration_seconds', round(time.perf_counter() - run_start, 3))
+        # Batches bump the version as they're committed; this covers any other write made during the run
+        bump_schedule_version()
+        # Idle keep-alive connections won't outlive the gap until the next run
+        HTTP_POOL.close()
+        logger.info("HTTP CACHE:  {}".format(HTTP_CACHE.stats))
+        logger.info("CLASSIFICATION CACHE:  {}".format(CLASS_CLASSIFIER.cache_info()))
+
+
+#
+# Move classes that started more than retention_days ago from EastonClass to ArchivedClass
+#
+# Rows are moved batch_size at a time, each batch in its own transaction, so the database is never locked for
+# long and an interrupted run keeps the batches already moved.
+#
+# params:
+# retention_days:  default settings.SCRAPER_RETENTION_DAYS
+# batch_size:  default settings.SCRAPER_ARCHIVE_BATCH
+#
+# returns:  number of classes archived
+#
+def archive_past_classes(retention_days=None, batch_size=None):
+
+    retention_days = retention_days if retention_days is not None else \
+        getattr(settings, 'SCRAPER_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+    batch_size = batch_size or getattr(settings, 'SCRAPER_ARCHIVE_BATCH', DEFAULT_ARCHIVE_BATCH)
+    cutoff = timezone.now() - timedelta(days=retention_days)
+
+    archived = 0
+    with SCRAPE_METRICS.time('archive'):
+        while True:
+            with transaction.atomic():
+                past_classes = list(EastonClass.objects.filter(start_time__lt=cutoff).order_by('id')[:batch_size])
+                if not past_classes:
+                    break
+                archived_at = timezone.now()
+                ArchivedClass.objects.bulk_create([ArchivedClass(
+                    gym=past_class.gym, category=past_class.category, class_id=past_class.class_id,
+                    name=past_class.name, requirements=past_class.requirements, start_time=past_class.start_time,
+                    end_time=past_class.end_time, canceled=past_class.canceled, archived_at=archived_at)
+                    for past_class in past_classes])
+                EastonClass.objects.filter(id__in=[past_class.id for past_class in past_classes]).delete()
+                bump_schedule_version()
+            archived += len(past_classes)
+
+    SCRAPE_METRICS.add('rows_archived', archived)
+    logger.info("ARCHIVED {} CLASSES BEFORE {}".format(archived, cutoff))
+    return archived
+
+
+#
+# Schedule version stamp, changed whenever scraped classes are committed
+#
+# Responses cached under one version are never served under another (see views.ResponseCache).  The stamp is kept
+# in the database (ScheduleVersion), so every process serving pages sees a change made by any other:  a scrape from
+# the scrape command, a job in another worker, archive_classes.  Writers bump it in the transaction that changes
+# the classes, so it can't be seen before (or without) the change.
+#
+# Reads only; the row is created by the first bump_schedule_version.  Until then the version is None.
+#
+def get_schedule_version():
+    try:
+        return ScheduleVersion.objects.values_list('version', flat=True).get(pk=SCHEDULE_VERSION_ID)
+    except ScheduleVersion.DoesNotExist:
+        return None
 
-    for calendar_data in CALENDAR_LINK_LIST:
-        # TODO gym reference is temp
-        if calendar_data[CALENDAR_LINK_TYPE_IDX] == EastonCalendarType.M:
-            easton_page = EastonMbCalendarPage(calendar_data[CALENDAR_LINK_GYM_IDX],
-                                               calendar_data[CALENDAR_LINK_URL_IDX])
-            mb_schedule_id = easton_page.get_inner_mbc_id()
-            mb_calendar = MindBodyCalendar(calendar_data[CALENDAR_LINK_GYM_IDX])
-            mb_calendar.get_class_data(mb_schedule_id, current_time, number_of_days)
 
+def bump_schedule_version():
+    ScheduleVersion.objects.update_or_create(pk=SCHEDULE_VERSION_ID, defaults={'version': uuid.uuid4().hex,
+                                                                               'updated_at': timezone.now()})
+
+
+#
+# Queue a scrape of number_of_days to run in the background (on its own thread), returns its ScrapeJob
+#
+# Single flight:  while another job is queued or running, that job is returned instead of queuing a new one (jobs
+# that stopped responding are failed first, see fail_stale_scrape_jobs).  Jobs started at the same moment by
+# different processes are kept apart by ScrapeLock, see run_scrape_job.
+#
+# background=False runs the job before returning.
+#
+def start_scrape_job(number_of_days, background=True):
+
+    now = timezone.now()
+    with transaction.atomic():
+        fail_stale_scrape_jobs(now)
+        active_job = ScrapeJob.objects.filter(status__in=[ScrapeJob.QUEUED, ScrapeJob.RUNNING]) \
+            .order_by('-requested_at').first()
+        if active_job is not None:
+            return active_job
+        job = ScrapeJob.objects.create(number_of_days=number_of_days, requested_at=now, heartbeat_at=now)
+
+    if background:
+        # Committed before the thread starts, so it can read the job
+        threading.Thread(target=run_scrape_job_thread, args=(job.pk,), name="scrape-job-{}".format(job.pk),
+                         daemon=True).start()
+    else:
+        run_scrape_job(job.pk)
+        job.refresh_from_db()
+    return job
+
+
+#
+# Run a queued ScrapeJob:  scrape every gym whose lock it gets, skip the rest
+#
+def run_scrape_job(job_id):
+
+    job = ScrapeJob.objects.get(pk=job_id)
+    job.status = ScrapeJob.RUNNING
+    job.started_at = job.heartbeat_at = timezone.now()
+    job.save(update_fields=['status', 'started_at', 'heartbeat_at'])
+
+    try:
+        calendar_list = []
+        skipped_gyms = []
+        for calendar_data in CALENDAR_LINK_LIST:
+            if acquire_scrape_lock(calendar_data[CALENDAR_LINK_GYM_IDX], job):
+                calendar_list.append(calendar_data)
+            else:
+                skipped_gyms.append(calendar_data[CALENDAR_LINK_GYM_IDX].name)
+        if skipped_gyms:
+            job.skipped_gyms = ",".join(skipped_gyms)
+            logger.info("SCRAPE JOB {}:  SKIPPING {}, ALREADY BEING SCRAPED".format(job.pk, job.skipped_gyms))
+        if calendar_list:
+            retrieve_data_from_web(job.number_of_days, calendar_list=calendar_list, progress=job)
+        job.status = ScrapeJob.SUCCEEDED
+    except Exception as e:
+        logger.exception("SCRAPE JOB {} FAILED".format(job.pk))
+        job.status = ScrapeJob.FAILED
+        job.error = "{}: {}".format(type(e).__name__, e)
+    finally:
+        ScrapeLock.objects.filter(job=job).delete()
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'finished_at', 'skipped_gyms', 'error'])
+
+
+def run_scrape_job_thread(job_id):
+    try:
+        run_scrape_job(job_id)
+    finally:
+        # Django opens a connection per thread, this one's thread is about to end
+        connection.close()
+
+
+#
+# Fail queued and running jobs with no heartbeat for the lock TTL
+#
+# Jobs run on daemon threads, so a restart (or a crash) of the process running one ends it without a word; without
+# this it would stay running, and block new jobs, for good.  Called before single flight and status reads.
+#
+def fail_stale_scrape_jobs(now=None):
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=get_scrape_lock_ttl())
+    # Jobs from before heartbeats have none, their request time will do
+    stale_jobs = ScrapeJob.objects.filter(Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at=None, requested_at__lt=cutoff),
+                                          status__in=[ScrapeJob.QUEUED, ScrapeJob.RUNNING])
+    stale_count = stale_jobs.update(status=ScrapeJob.FAILED, finished_at=now,
+                                    error="Stopped without finishing (process restarted?)")
+    if stale_count:
+        logger.warning("FAILED {} STALE SCRAPE JOBS".format(stale_count))
+
+
+def get_scrape_lock_ttl():
+    return getattr(settings, 'SCRAPER_LOCK_TTL', DEFAULT_SCRAPE_LOCK_TTL)
+
+
+#
+# returns:  True if job now holds gym's ScrapeLock, False if another job does
+#
+def acquire_scrape_lock(gym, job):
+
+    now = timezone.now()
+    with transaction.atomic():
+        # A job that died holding the lock won't release it
+        ScrapeLock.objects.filter(gym=gym, expires_at__lt=now).delete()
+        try:
+            with transaction.atomic():
+                ScrapeLock.objects.create(gym=gym, job=job,
+                                          expires_at=now + timedelta(seconds=get_scrape_lock_ttl()))
+        except IntegrityError:
+            return False
+    return True
+
+
+def retrieve_data_threaded(calendar_list, first_date, number_of_days, workers=None, progress=None, processes=None):
+
+    workers = workers or getattr(settings, 'SCRAPER_WORKERS', DEFAULT_SCRAPER_WORKERS)
+    processes = processes if processes is not None else \
+        getattr(settings, 'SCRAPER_PARSE_PROCESSES', DEFAULT_PARSE_PROCESSES)
+    schedule_id_cache = MindBodyScheduleIdCache()
+    detail_caches = get_detail_caches(calendar_list)
+    page_hashes = get_page_hash_cache(calendar_list, first_date)
+
+    parse_queue_size = getattr(settings, 'SCRAPER_PARSE_QUEUE_SIZE', DEFAULT_PARSE_QUEUE_SIZE)
+
+    with PARSE_POOL.use(processes, parse_queue_size), ThreadPoolExecutor(max_workers=workers) as executor:
+        # future -> (gym, calendar), for uncached MindBody schedule IDs (day fetches can't start until these finish)
+        schedule_id_futures = {}
+        # futures returning a ScrapedBatch (one MindBody day or one zencalendar week), or with parse processes, a
+        # MindBody day's future ScrapedBatch, still being parsed
+        day_futures = set()
+
+        for calendar_data in calendar_list:
+            gym = calendar_data[CALENDAR_LINK_GYM_IDX]
+            if calendar_data[CALENDAR_LINK_TYPE_IDX] == EastonCalendarType.M:
+                mb_calendar = MindBodyCalendar(gym, calendar_data[CALENDAR_LINK_URL_IDX], schedule_id_cache,
+                                               page_hashes)
+                schedule_id = schedule_id_cache.get(gym)
+                if schedule_id:
+                    day_futures.update(mb_calendar.submit_class_data(executor, schedule_id, first_date,
+                                                                     number_of_days, deferred=PARSE_POOL.active))
+                else:
+                    easton_page = EastonMbCalendarPage(gym, calendar_data[CALENDAR_LINK_URL_IDX])
+                    schedule_id_futures[executor.submit(easton_page.get_inner_mbc_id,
+                                                        schedule_id_cache.get_previous(gym))] = (gym, mb_calendar)
+
+            elif calendar_data[CALENDAR_LINK_TYPE_IDX] == EastonCalendarType.Z:
+                for week_dates in get_calendar_weeks(first_date, number_of_days):
+                    day_futures.add(executor.submit(get_calendar_week_data, gym, calendar_data[CALENDAR_LINK_URL_IDX],
+                                                    week_dates, detail_caches[gym], page_hashes))
+
+        pending = set(schedule_id_futures) | day_futures
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            batches = []
+            for future in done:
+                if future in schedule_id_futures:
+                    gym, mb_calendar = schedule_id_futures[future]
+                    schedule_id_cache.store(gym, future.result())
+                    pending |= set(mb_calendar.submit_class_data(executor, future.result(), first_date,
+                                                                  number_of_days, deferred=PARSE_POOL.active))
+                elif isinstance(future.result(), Future):
+                    pending.add(future.result())
+                else:
+                    batches.append(future.result())
+            # Batches finished while the last ones were being written are written together, in one commit
+            with transaction.atomic():
+                for batch in batches:
+                    store_batch(batch, progress)
+
+    schedule_id_cache.flush()
+    for detail_cache in detail_caches.values():
+        detail_cache.flush()
+    if page_hashes is not None:
+        page_hashes.flush()
+
+
+#
+# asyncio engine for retrieve_data_from_web
+#
+# Every gym, day (week, for zencalendar) and class detail page is a coroutine on one event loop; fetcher caps
+# the number of requests in flight.  Parsing and upserts are the same as the threaded engine, but off the loop so
+# it only waits on I/O:  parsing on asyncio.to_thread, upserts on a single writer thread.  The caches are loaded
+# and flushed on the loop's thread, once per run.
+#
+async def retrieve_data_async(calendar_list, first_date, number_of_days, fetcher=None, progress=None):
+
+    owns_fetcher = fetcher is None
+    fetcher = fetcher or AsyncFetcher()
+    schedule_id_cache = MindBodyScheduleIdCache()
+    detail_caches = get_detail_caches(calendar_list)
+    page_hashes = get_page_hash_cache(calendar_list, first_date)
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scrape-writer')
+
+    async def scrape_mindbody_gym(gym, page_url):
+        schedule_id = schedule_id_cache.get(gym)
+        if schedule_id is None:
+            schedule_id = await EastonMbCalendarPage(gym, page_url).get_inner_mbc_id_async(
+                fetcher, schedule_id_cache.get_previous(gym))
+            schedule_id_cache.store(gym, schedule_id)
+        mb_calendar = MindBodyCalendar(gym, page_url, schedule_id_cache, page_hashes)
+        await asyncio.gather(*[store_day(mb_calendar.get_day_data_async(fetcher, schedule_id,
+                                                                        first_date + timedelta(days=day_number)))
+                               for day_number in range(number_of_days)])
+
+    async def store_day(day_coroutine):
+        batch = await day_coroutine
+        await asyncio.get_running_loop().run_in_executor(writer, store_batch, batch, progress)
+
+    gym_coroutines = []
+    for calendar_data in calendar_list:
+        gym = calendar_data[CALENDAR_LINK_GYM_IDX]
+        if calendar_data[CALENDAR_LINK_TYPE_IDX] == EastonCalendarType.M:
+            gym_coroutines.append(scrape_mindbody_gym(gym, calendar_data[CALENDAR_LINK_URL_IDX]))
         elif calendar_data[CALENDAR_LINK_TYPE_IDX] == EastonCalendarType.Z:
-            get_calendar_daily_data(calendar_data[CALENDAR_LINK_GYM_IDX],
-                                    calendar_data[CALENDAR_LINK_URL_IDX], current_time, number_of_days)
+            gym_coroutines.extend(store_day(get_calendar_week_data_async(fetcher, gym,
+                                                                         calendar_data[CALENDAR_LINK_URL_IDX],
+                                                                         week_dates, detail_caches[gym],
+                                                                         page_hashes))
+                                  for week_dates in get_calendar_weeks(first_date, number_of_days))
+    try:
+        await asyncio.gather(*gym_coroutines)
+    finally:
+        # Django opens a connection per thread, the writer's is done
+        writer.submit(connection.close)
+        writer.shutdown()
+        if owns_fetcher:
+            await fetcher.close()
+
+    schedule_id_cache.flush()
+    for detail_cache in detail_caches.values():
+        detail_cache.flush()
+    if page_hashes is not None:
+        page_hashes.flush()
+
+
+#
+# One engine batch:  a MindBody day or zencalendar week
+#
+# gym:  EastonGym scraped
+# dates:  days whose pages were read, so classes stored for them but missing from 'classes' are gone from the
+#     schedule (none if every page was unchanged)
+# classes:  EastonClass list parsed
+#
+ScrapedBatch = namedtuple('ScrapedBatch', ['gym', 'dates', 'classes'])
+
+
+# Store one engine batch, then reconcile its days; a batch that changed anything bumps the schedule version with it
+def store_batch(batch, progress=None):
+    with transaction.atomic():
+        inserted, updated = bulk_upsert(batch.classes)
+        canceled = cancel_missing_classes(batch.gym, batch.dates, batch.classes)
+        if inserted or updated or canceled:
+            bump_schedule_version()
+    if progress is not None:
+        progress.batch_stored(inserted + updated)
+
+
+#
+# Mark the classes stored for a gym on the given days, but no longer listed on those days, as canceled
+#
+# One UPDATE for every day of a batch; the database takes the difference between the stored and scraped class
+# IDs.  A canceled class that's listed again is restored by bulk_upsert.
+#
+# params:
+# dates:  days whose pages were read in full
+# easton_classes:  every class scraped from those pages
+#
+# returns:  number of classes canceled
+#
+def cancel_missing_classes(gym, dates, easton_classes):
+
+    if not dates:
+        return 0
+    days = Q()
+    for date in dates:
+        day_start = timezone.make_aware(datetime.combine(get_page_date(date), datetime.min.time()))
+        days |= Q(start_time__gte=day_start, start_time__lt=day_start + timedelta(days=1))
+    canceled = EastonClass.objects.filter(days, gym=gym, canceled=False) \
+        .exclude(class_id__in={str(easton_class.class_id) for easton_class in easton_classes}) \
+        .update(canceled=True)
+    if canceled:
+        SCRAPE_METRICS.add('rows_canceled', canceled, get_gym_label(gym))
+        logger.info("CANCELED {} {} CLASSES".format(canceled, gym))
+    return canceled
+
+
+# Number of store_batch calls a scrape will make
+def count_scrape_batches(calendar_list, first_date, number_of_days):
+    zen_weeks = len(get_calendar_weeks(first_date, number_of_days))
+    return sum(number_of_days if calendar_data[CALENDAR_LINK_TYPE_IDX] == EastonCalendarType.M else zen_weeks
+               for calendar_data in calendar_list)
+
+
+#
+# returns:  dict of gym -> ZenClassDetailCache, for each zencalendar gym in calendar_list
+#
+def get_detail_caches(calendar_list):
+    return {calendar_data[CALENDAR_LINK_GYM_IDX]: ZenClassDetailCache(calendar_data[CALENDAR_LINK_GYM_IDX])
+            for calendar_data in calendar_list if calendar_data[CALENDAR_LINK_TYPE_IDX] == EastonCalendarType.Z}
+
+
+#
+# Parse a fetched page with the configured parser, building a tree of only the tags matching strainer
+#
+def make_soup(html, strainer=None):
+    parser = getattr(settings, 'SCRAPER_HTML_PARSER', DEFAULT_HTML_PARSER)
+    # html5lib always builds the whole tree
+    if not getattr(settings, 'SCRAPER_HTML_STRAINERS', True) or parser == "html5lib":
+        strainer = None
+    return BeautifulSoup(html, parser, parse_only=strainer)
 
 
 class EastonMbCalendarPage:
@@ -207,352 +840,1325 @@ class EastonMbCalendarPage:
     # (Easton's page has a javascript link which loads the schedule, we have to connect to mindbody's site
     #  with this ID to get the class data)
     #
-    def get_inner_mbc_id(self):
-        easton_request = Request(self._page_url, headers={'User-Agent': "lmccrone"})
-        schedule = urlopen(easton_request)
-        soup = BeautifulSoup(schedule.read())
+    # previous_id:  schedule ID last read from this page, if known.  The page is then fetched conditionally, and
+    #               previous_id returned if it's unchanged.
+    #
+    def get_inner_mbc_id(self, previous_id=None):
+        with gym_label(self._location):
+            html = fetch(self._page_url, headers=EASTON_REQUEST_HEADERS, conditional=previous_id is not None)
+            return self.parse_inner_mbc_id(html) if html is not None else previous_id
+
+    async def get_inner_mbc_id_async(self, fetcher, previous_id=None):
+        with gym_label(self._location):
+            html = await fetcher.fetch(self._page_url, headers=EASTON_REQUEST_HEADERS,
+                                       conditional=previous_id is not None)
+            return self.parse_inner_mbc_id(html) if html is not None else previous_id
+
+    @staticmethod
+    @timed('parse')
+    def parse_inner_mbc_id(html):
+        soup = make_soup(html, SCHEDULE_ID_STRAINER)
         schedule_id = soup.find_all('healcode-widget')[0]['data-widget-id']
         return schedule_id
 
 
 class MindBodyCalendar:
 
-    def __init__(self, location):
+    def __init__(self, location, page_url=None, schedule_id_cache=None, page_hashes=None):
         self._location = location
+        # Easton schedule page and MindBodyScheduleIdCache, used to replace a rejected schedule ID
+        self._page_url = page_url
+        self._schedule_id_cache = schedule_id_cache
+        # Optional PageHashCache, to skip unchanged days
+        self._page_hashes = page_hashes
 
     def get_class_data(self, schedule_id, first_date, number_of_days=1):
 
-        request_str = "https://widgets.healcode.com/widgets/schedules/" + schedule_id + "/print"
-
         gym_class_list = []
         for day_number in range(number_of_days):
             logger.info("TIMEDELTA:  " + str(day_number))
             # Call MindBody widget with the schedule ID and the specific day
-            day_calendar = MindBodyDailyCalendar(self._location, request_str, first_date + timedelta(days=day_number))
-            gym_class_list.extend(day_calendar.get_class_data())
+            gym_class_list.extend(self.get_day_data(schedule_id, first_date + timedelta(days=day_number)).classes)
             logger.info("TOTAL SIZE:  " + str(len(gym_class_list)))
         return gym_class_list
 
+    #
+    # Same as get_class_data, but each day is fetched on the given executor.  Returns one future per day,
+    # each resolving to that day's ScrapedBatch (deferred:  see get_day_data).
+    #
+    def submit_class_data(self, executor, schedule_id, first_date, number_of_days=1, deferred=False):
+
+        return [executor.submit(self.get_day_data, schedule_id, first_date + timedelta(days=day_number), deferred)
+                for day_number in range(number_of_days)]
+
+    #
+    # Get one day's classes, as a ScrapedBatch.  If the widget endpoint rejects the schedule ID (it may be a stale
+    # cached one), the ID is resolved again from the Easton schedule page and the day retried.
+    #
+    # deferred:  hand the page to PARSE_POOL and return a Future of the ScrapedBatch rather than wait for it
+    #
+    def get_day_data(self, schedule_id, date, deferred=False):
+        try:
+            daily_class_list = self.get_daily_calendar(schedule_id, date).get_class_data(deferred)
+        except HTTPError:
+            if self._schedule_id_cache is None:
+                raise
+            easton_page = EastonMbCalendarPage(self._location, self._page_url)
+            new_id = self._schedule_id_cache.refresh(self._location, schedule_id, easton_page.get_inner_mbc_id)
+            if new_id is None:
+                raise
+            daily_class_list = self.get_daily_calendar(new_id, date).get_class_data(deferred)
+        if isinstance(daily_class_list, Future):
+            return chain_future(daily_class_list, lambda parsed_classes: self.get_day_batch(date, parsed_classes))
+        return self.get_day_batch(date, daily_class_list)
+
+    async def get_day_data_async(self, fetcher, schedule_id, date):
+        try:
+            daily_class_list = await self.get_daily_calendar(schedule_id, date).get_class_data_async(fetcher)
+        except HTTPError:
+            if self._schedule_id_cache is None:
+                raise
+            easton_page = EastonMbCalendarPage(self._location, self._page_url)
+            new_id = await self._schedule_id_cache.refresh_async(
+                self._location, schedule_id, lambda: easton_page.get_inner_mbc_id_async(fetcher))
+            if new_id is None:
+                raise
+            daily_class_list = await self.get_daily_calendar(new_id, date).get_class_data_async(fetcher)
+        return self.get_day_batch(date, daily_class_list)
+
+    # An unchanged day (None) has nothing to store or reconcile
+    def get_day_batch(self, date, daily_class_list):
+        if daily_class_list is None:
+            return ScrapedBatch(self._location, [], [])
+        return ScrapedBatch(self._location, [date], daily_class_list)
+
+    def get_daily_calendar(self, schedule_id, date):
+        return MindBodyDailyCalendar(self._location, self.get_request_str(schedule_id), date, self._page_hashes)
+
+    @staticmethod
+    def get_request_str(schedule_id):
+        return MINDBODY_WIDGET_URL.format(schedule_id)
+
 
 class MindBodyDailyCalendar:
 
-    def __init__(self, location, webpage, date):
+    def __init__(self, location, webpage, date, page_hashes=None):
         self._location = location
         self._webpage = webpage
         self._date = date
+        self._page_hashes = page_hashes
 
-    def get_class_data(self):
-        request_str = self._webpage + "?options%5Bstart_date%5D=" + datetime.strftime(self._date, "%Y-%m-%d")
-        logger.info("REQUEST_STR: " + request_str)
-        mind_body_request = Request(request_str)
-        schedule = urlopen(mind_body_request)
-        soup = BeautifulSoup(schedule.read())
+    def get_request_str(self):
+        return self._webpage + "?options%5Bstart_date%5D=" + datetime.strftime(self._date, "%Y-%m-%d")
+
+    #
+    # returns:  the day's classes, or None if the page is unchanged since it was last stored (deferred:  see
+    # parse_changed_page)
+    #
+    def get_class_data(self, deferred=False):
+        request_str = self.get_request_str()
+        logger.debug("REQUEST_STR: " + request_str)
+        with gym_label(self._location):
+            # Streaming parses on the fetch thread as the page arrives; with parse processes, pages are read whole and
+            # parsed there instead
+            if getattr(settings, 'SCRAPER_STREAM_PARSING', False) and not PARSE_POOL.active:
+                return self.get_streamed_class_data(fetch_chunks(request_str, conditional=self.is_page_stored(),
+                                                                 store_validators=True))
+            html = fetch(request_str, conditional=self.is_page_stored(), store_validators=True)
+            return self.parse_changed_page(html, deferred) if html is not None else None
+
+    async def get_class_data_async(self, fetcher):
+        with gym_label(self._location):
+            html = await fetcher.fetch(self.get_request_str(), conditional=self.is_page_stored(),
+                                       store_validators=True)
+            # Parsing is CPU-bound, keep it off the event loop
+            return await asyncio.to_thread(self.parse_changed_page, html) if html is not None else None
+
+    # The page is fetched conditionally only if a 304 would mean its classes are stored, see PageHashCache
+    def is_page_stored(self):
+        return self._page_hashes is not None and self._page_hashes.is_stored(self._location, self._date, self._date)
+
+    #
+    # iter_class_data for a page from fetch_chunks, unless it's unchanged:  not modified (no chunks at all; an empty
+    # page is one empty chunk), or its hash shows it's the same as when it was last stored (see PageHashCache)
+    #
+    # The page is hashed as its chunks are parsed, so the hash is only known once it's all in:  an unchanged page
+    # is still parsed, but its classes aren't written.
+    #
+    def get_streamed_class_data(self, chunks):
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return None
+        page_hash = self._page_hashes.new_page_hash() if self._page_hashes is not None else None
+
+        def hash_chunks():
+            for chunk in itertools.chain([first_chunk], chunks):
+                if page_hash is not None:
+                    page_hash.update(chunk)
+                yield chunk
+        daily_class_list = list(self.iter_class_data(hash_chunks()))
+        if page_hash is not None:
+            if self._page_hashes.is_unchanged(self._location, self._date, self._date, page_hash.hexdigest()):
+                return None
+            self._page_hashes.store(self._location, self._date, self._date, page_hash.hexdigest(), daily_class_list)
+        return daily_class_list
+
+    #
+    # parse_class_data, unless the page's hash shows it's unchanged since it was last stored (see PageHashCache)
+    #
+    # deferred:  return a Future of the classes, from PARSE_POOL, rather than wait for them
+    #
+    def parse_changed_page(self, html, deferred=False):
+        page_hash = None
+        if self._page_hashes is not None:
+            page_hash = self._page_hashes.get_page_hash(html)
+            if self._page_hashes.is_unchanged(self._location, self._date, self._date, page_hash):
+                return None
+
+        def store_page_hash(daily_class_list):
+            if page_hash is not None:
+                self._page_hashes.store(self._location, self._date, self._date, page_hash, daily_class_list)
+            return daily_class_list
+        if deferred:
+            return chain_future(PARSE_POOL.submit(parse_mindbody_page, self._location, self._date, html),
+                                store_page_hash)
+        return store_page_hash(PARSE_POOL.run(parse_mindbody_page, self._location, self._date, html))
+
+    @timed('parse')
+    def parse_class_data(self, html):
+        soup = make_soup(html, TABLE_ROW_STRAINER)
         table_rows = soup.find_all('tr')
         current_category = ""
         daily_class_list = []
 
+        # Formatting every row is a large share of parse time, skip it unless it will be written
+        log_rows = logger.isEnabledFor(logging.DEBUG)
         for table_row in table_rows:
-            logger.info(table_row)
+            if log_rows:
+                logger.debug(table_row)
 
             # TODO comments - what's actually going on here
             if 'hc_class' in table_row.get('class'):
-                easton_class = EastonClass()
-                # Littleton uses 'data-bw-widget-mbo-class-id' instead of 'data-hc-mbo-class-id'
-                easton_class.gym = self._location
-                class_id_tag = 'data-bw-widget-mbo-class-id' if easton_class.gym == EastonGym.LI \
-                    else 'data-hc-mbo-class-id'
-                easton_class.class_id = table_row.get(class_id_tag)
-                easton_class.mindbody_category = current_category
-                easton_class.name = table_row.find('span', {'class': 'classname'}).text
-                class_date = datetime.strftime(self._date, "%Y-%m-%d")
-                start_hr_time = table_row.find('span', {'class': 'hc_starttime'}).text
-                # [2:] - remove dash at beginning of end time
-                end_hr_time = table_row.find('span', {'class': 'hc_endtime'}).text[2:]
-                easton_class.start_time = datetime.strptime(
-                    class_date + ' ' + start_hr_time, '%Y-%m-%d %I:%M %p')
-                easton_class.start_time.astimezone(pytz.timezone('US/Mountain'))
-                easton_class.end_time = datetime.strptime(
-                    class_date + ' ' + end_hr_time, '%Y-%m-%d %I:%M %p')
-                easton_class.end_time.astimezone(pytz.timezone('US/Mountain'))
-                easton_class.requirements = EastonRequirements.NSE
-                easton_class.category = EastonClassCategory.NSE
-                get_list_category(easton_class)
-
-                insert_or_update(easton_class)
+                daily_class_list.append(self.build_class(
+                    table_row.get(self.get_class_id_attr()), current_category,
+                    table_row.find('span', {'class': 'classname'}).text,
+                    table_row.find('span', {'class': 'hc_starttime'}).text,
+                    table_row.find('span', {'class': 'hc_endtime'}).text))
 
             # Class category divider
             if 'group_by_class_type' in table_row.get('class'):
                 current_category = table_row.find('td').text
 
-        logger.info("CLASS SIZE: " + str(len(daily_class_list)))
+        classify_classes(daily_class_list)
+        logger.debug("CLASS SIZE: " + str(len(daily_class_list)))
         return daily_class_list
 
+    #
+    # Streaming counterpart of parse_class_data
+    #
+    # params:
+    # chunks:  iterable of the page's bytes (UTF-8), e.g. fetch_chunks()
+    #
+    # Classes are parsed, classified and yielded as soon as the chunk closing their rows is read, without keeping
+    # the page or a tree of it in memory.
+    #
+    def iter_class_data(self, chunks):
+        parser = MindBodyRowParser()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        # Lists of the rows each chunk closes
+        def read_row_lists():
+            for chunk in chunks:
+                with SCRAPE_METRICS.time('parse'):
+                    parser.feed(decoder.decode(chunk))
+                yield parser.pop_rows()
+            with SCRAPE_METRICS.time('parse'):
+                parser.feed(decoder.decode(b'', final=True))
+                parser.close()
+            yield parser.pop_rows()
+
+        current_category = ""
+        for rows in read_row_lists():
+            easton_classes = []
+            for row in rows:
+                if 'hc_class' in row.classes:
+                    easton_classes.append(self.build_class(
+                        row.attrs.get(self.get_class_id_attr()), current_category, row.texts.get('classname'),
+                        row.texts.get('hc_starttime'), row.texts.get('hc_endtime')))
+                if 'group_by_class_type' in row.classes:
+                    current_category = row.texts.get('td', "")
+            if easton_classes:
+                classify_classes(easton_classes)
+                yield from easton_classes
+
+    # Littleton uses 'data-bw-widget-mbo-class-id' instead of 'data-hc-mbo-class-id'
+    def get_class_id_attr(self):
+        return 'data-bw-widget-mbo-class-id' if self._location == EastonGym.LI else 'data-hc-mbo-class-id'
+
+    def build_class(self, class_id, mindbody_category, name, start_hr_time, end_hr_time):
+        easton_class = EastonClass()
+        easton_class.gym = self._location
+        easton_class.class_id = class_id
+        easton_class.mindbody_category = mindbody_category
+        easton_class.name = name
+        class_date = datetime.strftime(self._date, "%Y-%m-%d")
+        easton_class.start_time = datetime.strptime(
+            class_date + ' ' + start_hr_time, '%Y-%m-%d %I:%M %p')
+        easton_class.start_time.astimezone(pytz.timezone('US/Mountain'))
+        # [2:] - remove dash at beginning of end time
+        easton_class.end_time = datetime.strptime(
+            class_date + ' ' + end_hr_time[2:], '%Y-%m-%d %I:%M %p')
+        easton_class.end_time.astimezone(pytz.timezone('US/Mountain'))
+        easton_class.requirements = EastonRequirements.NSE
+        easton_class.category = EastonClassCategory.NSE
+        return easton_class
+
+
+# MindBodyDailyCalendar.parse_class_data for one day's page, as a ParsePool task
+def parse_mindbody_page(location, date, html):
+    return MindBodyDailyCalendar(location, None, date).parse_class_data(html)
+
+
+# One MindBody print view table row, as read by MindBodyRowParser
+# classes:  the row's CSS classes
+# attrs:  the row's attributes
+# texts:  text of the row's first td, and of its first span of each of MindBodyRowParser.ROW_SPANS classes
+MindBodyRow = namedtuple('MindBodyRow', ['classes', 'attrs', 'texts'])
 
-def insert_or_update(easton_class):
 
-    # Check if field already exists in database
-    try:
-        old_class = EastonClass.objects.get(gym=easton_class.gym, class_id=str(easton_class.class_id))
-        old_class.gym = easton_class.gym
-        old_class.name = easton_class.name
-        old_class.start_time = easton_class.start_time
-        old_class.end_time = easton_class.end_time
-        old_class.requirements = easton_class.requirements
-        old_class.category = easton_class.category
-        old_class.save()
+#
+# Incremental parser for MindBody print view table rows
+#
+# Fed the page a piece at a time; keeps only the row being read and what parse_class_data looks at in it.
+# Finished rows are returned by pop_rows().
+#
+class MindBodyRowParser(HTMLParser):
+
+    ROW_SPANS = ('classname', 'hc_starttime', 'hc_endtime')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._rows = []
+        self._row = None
+        # Elements whose text is being collected:  [tag, nested tags of the same name, texts key, text pieces]
+        self._captures = []
+
+    def pop_rows(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self._end_row()
+            attrs = dict(attrs)
+            self._row = MindBodyRow((attrs.get('class') or "").split(), attrs, {})
+            return
+        if self._row is None:
+            return
+        for capture in self._captures:
+            if capture[0] == tag:
+                capture[1] += 1
+
+        key = None
+        if tag == 'td' and 'td' not in self._row.texts:
+            key = 'td'
+        elif tag == 'span':
+            for span_class in (dict(attrs).get('class') or "").split():
+                if span_class in self.ROW_SPANS and span_class not in self._row.texts:
+                    key = span_class
+                    break
+        if key is not None:
+            # Reserve the key so later elements of the same kind are skipped, like find() in parse_class_data
+            self._row.texts[key] = ""
+            self._captures.append([tag, 0, key, []])
+
+    def handle_endtag(self, tag):
+        if tag == 'tr':
+            self._end_row()
+            return
+        for capture in list(self._captures):
+            if capture[0] != tag:
+                continue
+            if capture[1]:
+                capture[1] -= 1
+            else:
+                self._finish_capture(capture)
+
+    def handle_data(self, data):
+        for capture in self._captures:
+            capture[3].append(data)
+
+    def close(self):
+        super().close()
+        self._end_row()
+
+    def _finish_capture(self, capture):
+        self._captures.remove(capture)
+        self._row.texts[capture[2]] = "".join(capture[3])
+
+    def _end_row(self):
+        if self._row is None:
+            return
+        for capture in list(self._captures):
+            self._finish_capture(capture)
+        self._rows.append(self._row)
+        self._row = None
+
+
+#
+# Inserts or updates a batch of parsed classes (one MindBody day or one zencalendar week), keyed on (gym, class_id)
+#
+# Existing rows are read with one IN query per UPSERT_LOOKUP_CHUNK classes (SQLite caps query parameters at 999),
+# then new and changed rows are written with bulk_create / bulk_update in a single transaction.  Rows whose
+# UPSERT_FIELDS all match the parsed class aren't written at all.  The same class parsed twice in one batch is
+# written once, last one wins.
+#
+# returns:  (number inserted, number updated), unchanged rows aren't counted
+#
+def bulk_upsert(easton_classes):
+
+    parsed_classes = {}
+    for easton_class in easton_classes:
+        easton_class.class_id = str(easton_class.class_id)
+        parsed_classes[(str(easton_class.gym), easton_class.class_id)] = easton_class
+    if not parsed_classes:
+        return 0, 0
+
+    keys = list(parsed_classes)
+    # Batches hold one gym's classes, label them with it even though they're written on the calling thread
+    gyms = {gym for gym, _ in keys}
+    gym = get_gym_label(gyms.pop()) if len(gyms) == 1 else None
+    with SCRAPE_METRICS.time('upsert', gym), transaction.atomic():
+        existing_classes = {}
+        for chunk_start in range(0, len(keys), UPSERT_LOOKUP_CHUNK):
+            chunk = keys[chunk_start:chunk_start + UPSERT_LOOKUP_CHUNK]
+            # Filtering gyms and class IDs separately can match extra rows (another gym's class with the same ID),
+            # those are dropped by the key lookup below
+            for old_class in EastonClass.objects.filter(gym__in={gym for gym, _ in chunk},
+                                                        class_id__in={class_id for _, class_id in chunk}):
+                existing_classes[(old_class.gym, old_class.class_id)] = old_class
+
+        new_classes = []
+        updated_classes = []
+        for key, easton_class in parsed_classes.items():
+            old_class = existing_classes.get(key)
+            if old_class is None:
+                new_classes.append(easton_class)
+                continue
+            if all(get_stored_value(getattr(old_class, field)) == get_stored_value(getattr(easton_class, field))
+                   for field in UPSERT_FIELDS):
+                continue
+            for field in UPSERT_FIELDS:
+                setattr(old_class, field, getattr(easton_class, field))
+            updated_classes.append(old_class)
+
+        EastonClass.objects.bulk_create(new_classes, batch_size=UPSERT_WRITE_BATCH)
+        EastonClass.objects.bulk_update(updated_classes, UPSERT_FIELDS, batch_size=UPSERT_WRITE_BATCH)
+
+    SCRAPE_METRICS.add('rows_inserted', len(new_classes), gym)
+    SCRAPE_METRICS.add('rows_updated', len(updated_classes), gym)
+    SCRAPE_METRICS.add('rows_unchanged', len(parsed_classes) - len(new_classes) - len(updated_classes), gym)
+    logger.debug("UPSERTED CLASSES:  {} new, {} updated".format(len(new_classes), len(updated_classes)))
+    return len(new_classes), len(updated_classes)
+
+
+# A field value as the database holds it:  enums as their str(), naive times in the default time zone
+def get_stored_value(value):
+    if isinstance(value, Enum):
+        return str(value)
+    if isinstance(value, datetime) and timezone.is_naive(value):
+        return timezone.make_aware(value)
+    return value
+
+
+#
+# Hit/miss counters for the scraper's caches, safe to update from worker threads
+#
+class CacheStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return "HITS:  {}, MISSES:  {}, HIT RATIO:  {:.2f}".format(self.hits, self.misses, self.hit_ratio)
+
+
+# Totals for every ZenClassDetailCache in this process
+ZEN_DETAIL_CACHE_STATS = CacheStats()
+
+
+#
+# Persistent cache of zencalendar class times, keyed by (gym, appointment ID), see ZenClassDetail
+#
+# A gym's entries are loaded with one query when the cache is created, looked up and stored in memory while
+# scraping (from any thread), and written back by flush().  Entries expire after ttl seconds; once written
+# back, the table is trimmed to the max_entries most recently fetched.
+#
+# Create and flush on the thread that owns the database connection, as with bulk_upsert.
+#
+class ZenClassDetailCache:
+
+    def __init__(self, gym, ttl=None, max_entries=None):
+        self._gym = gym
+        self._ttl = timedelta(seconds=ttl or getattr(settings, 'SCRAPER_ZEN_DETAIL_CACHE_TTL',
+                                                         DEFAULT_ZEN_DETAIL_CACHE_TTL))
+        self._max_entries = max_entries or getattr(settings, 'SCRAPER_ZEN_DETAIL_CACHE_SIZE',
+                                                   DEFAULT_ZEN_DETAIL_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self._entries = {detail.appointment_id: detail for detail in ZenClassDetail.objects.filter(gym=gym)}
+        self._updated = {}
+        self.stats = CacheStats()
+
+    #
+    # returns:  cached class time for the listed class, or None if it has to be fetched
+    #
+    def lookup(self, date_string, calendar_item):
+        detail = self._entries.get(calendar_item.class_id)
+        hit = detail is not None and \
+            detail.listing_hash == self.get_listing_hash(date_string, calendar_item) and \
+            detail.fetched_at > timezone.now() - self._ttl
+        self.stats.record(hit)
+        ZEN_DETAIL_CACHE_STATS.record(hit)
+        return detail.class_time if hit else None
+
+    def store(self, date_string, calendar_item, class_time):
+        detail = ZenClassDetail(gym=self._gym, appointment_id=calendar_item.class_id,
+                                listing_hash=self.get_listing_hash(date_string, calendar_item),
+                                class_time=class_time, fetched_at=timezone.now())
+        with self._lock:
+            self._entries[calendar_item.class_id] = detail
+            self._updated[calendar_item.class_id] = detail
+
+    #
+    # Look up the class time, fetching and caching the info page on a miss
+    #
+    def get_class_time(self, date_string, calendar_item, fetch_class_time):
+        class_time = self.lookup(date_string, calendar_item)
+        if class_time is None:
+            class_time = fetch_class_time()
+            self.store(date_string, calendar_item, class_time)
+        return class_time
+
+    #
+    # Write new and refreshed entries back, then drop expired and least recently fetched entries
+    #
+    def flush(self):
+        with self._lock:
+            updated = list(self._updated.values())
+            self._updated = {}
+        with transaction.atomic():
+            ZenClassDetail.objects.filter(gym=self._gym,
+                                          appointment_id__in=[detail.appointment_id for detail in updated]).delete()
+            ZenClassDetail.objects.bulk_create(updated)
+            ZenClassDetail.objects.filter(fetched_at__lte=timezone.now() - self._ttl).delete()
+            overflow = ZenClassDetail.objects.order_by('-fetched_at') \
+                .values_list('fetched_at', flat=True)[self._max_entries:self._max_entries + 1]
+            if overflow:
+                ZenClassDetail.objects.filter(fetched_at__lte=overflow[0]).delete()
+        logger.info("ZEN DETAIL CACHE {}:  {}".format(self._gym, self.stats))
+
+    @staticmethod
+    def get_listing_hash(date_string, calendar_item):
+        listing = "\n".join([date_string, calendar_item.category, calendar_item.name])
+        return hashlib.sha1(listing.encode('utf-8')).hexdigest()
+
+
+# Totals for every MindBodyScheduleIdCache in this process
+SCHEDULE_ID_CACHE_STATS = CacheStats()
+
+
+#
+# Content hashes of the pages a scrape parses, see ScrapedPage
+#
+# A page whose hash matches the one stored by an earlier scrape is skipped:  not parsed, classified or written.
+# The hash covers the classification rules too (ClassClassifier.rules_text, outcomes included), so changed rules
+# get every page parsed again.  A page is only
+# skipped while at least as many classes as were stored from it are still in the database for its days.
+#
+# A 304 skips a page before its hash can be checked, so pages are only fetched conditionally while is_stored():
+# stored with the current rules, and with their classes still there.  Otherwise (changed rules, deleted, archived
+# or wiped classes) the validators in HTTP_CACHE say nothing about the database, and the page is fetched in full.
+#
+# Loaded with one query per table when created and written back by flush(), like ZenClassDetailCache; flush
+# only after every page's classes are stored, or a failed scrape would skip them next time.
+#
+class PageHashCache:
+
+    def __init__(self, calendar_list, first_date):
+        gyms = [str(calendar_data[CALENDAR_LINK_GYM_IDX]) for calendar_data in calendar_list]
+        self._first_date = get_page_date(first_date)
+        self._lock = threading.Lock()
+        self._rules_hash = hashlib.sha1((str(PAGE_HASH_VERSION) + CLASS_CLASSIFIER.rules_text).encode('utf-8'))
+        self._rules_digest = self._rules_hash.hexdigest()
+        self._entries = {(page.gym, page.first_date): page
+                         for page in ScrapedPage.objects.filter(gym__in=gyms, last_date__gte=self._first_date)}
+        # (gym, date) -> classes stored for that day
+        self._day_counts = {(day_count['gym'], day_count['day']): day_count['classes']
+                            for day_count in EastonClass.objects
+                            .filter(gym__in=gyms, canceled=False, start_time__gte=timezone.make_aware(
+                                datetime.combine(self._first_date, datetime.min.time())))
+                            .annotate(day=TruncDate('start_time')).values('gym', 'day')
+                            .annotate(classes=Count('id'))}
+        self._updated = {}
+        self.stats = CacheStats()
+
+    def get_page_hash(self, html):
+        page_hash = self.new_page_hash()
+        page_hash.update(html)
+        return page_hash.hexdigest()
+
+    # hashlib object to update() with a page's bytes as they arrive, giving get_page_hash's hexdigest()
+    def new_page_hash(self):
+        return self._rules_hash.copy()
+
+    #
+    # returns:  True if the page was stored with this hash and its classes are still there, so it can be skipped
+    #
+    def is_unchanged(self, gym, first_date, last_date, page_hash):
+        page = self._entries.get((str(gym), get_page_date(first_date)))
+        unchanged = page is not None and page.content_hash == page_hash and self.is_stored(gym, first_date, last_date)
+        self.stats.record(unchanged)
+        if unchanged:
+            SCRAPE_METRICS.add('pages_unchanged')
+        return unchanged
+
+    #
+    # returns:  True if the page was stored with the current rules and its classes are still there, so a 304 for it
+    # can be trusted
+    #
+    def is_stored(self, gym, first_date, last_date):
+        first_date, last_date = get_page_date(first_date), get_page_date(last_date)
+        page = self._entries.get((str(gym), first_date))
+        return page is not None and page.rules_hash == self._rules_digest and page.last_date == last_date and \
+            sum(self._day_counts.get((str(gym), first_date + timedelta(days=day_number)), 0)
+                for day_number in range((last_date - first_date).days + 1)) >= page.class_count
+
+    def store(self, gym, first_date, last_date, page_hash, easton_classes):
+        first_date = get_page_date(first_date)
+        page = ScrapedPage(gym=gym, first_date=first_date, last_date=get_page_date(last_date),
+                           content_hash=page_hash, rules_hash=self._rules_digest,
+                           class_count=len({str(easton_class.class_id) for easton_class in easton_classes}),
+                           scraped_at=timezone.now())
+        with self._lock:
+            self._entries[(str(gym), first_date)] = page
+            self._updated[(str(gym), first_date)] = page
+
+    #
+    # Write new and changed hashes back, and drop the ones for days before this scrape
+    #
+    def flush(self):
+        with self._lock:
+            updated = list(self._updated.values())
+            self._updated = {}
+        with transaction.atomic():
+            for page in updated:
+                ScrapedPage.objects.filter(gym=page.gym, first_date=page.first_date).delete()
+            ScrapedPage.objects.bulk_create(updated)
+            ScrapedPage.objects.filter(last_date__lt=self._first_date).delete()
+        logger.info("PAGE HASH CACHE:  {}".format(self.stats))
+
+
+#
+# returns:  a PageHashCache for a scrape of calendar_list from first_date, or None if settings.SCRAPER_DIFFERENTIAL
+# is off
+#
+def get_page_hash_cache(calendar_list, first_date):
+    if not getattr(settings, 'SCRAPER_DIFFERENTIAL', True):
+        return None
+    return PageHashCache(calendar_list, first_date)
 
-        logger.debug("UPDATED CLASS: {}".format(easton_class))
-    except EastonClass.DoesNotExist:
-        easton_class.save()
-        logger.debug("SAVED NEW CLASS: {}".format(easton_class))
-    # daily_class_list.append(easton_class)
+
+def get_page_date(date):
+    return date.date() if isinstance(date, datetime) else date
+
+
+#
+# Persistent cache of MindBody schedule IDs, see MindBodyScheduleId
+#
+# Loaded with one query when created and written back by flush(), like ZenClassDetailCache.  A cached ID
+# older than ttl seconds counts as a miss.  A cached ID that the widget endpoint rejects is replaced once per
+# run through refresh().
+#
+class MindBodyScheduleIdCache:
+
+    def __init__(self, ttl=None):
+        self._ttl = timedelta(seconds=ttl or getattr(settings, 'SCRAPER_SCHEDULE_ID_TTL', DEFAULT_SCHEDULE_ID_TTL))
+        self._lock = threading.Lock()
+        self._entries = {entry.gym: entry for entry in MindBodyScheduleId.objects.all()}
+        # Gyms resolved during this run, there's no point resolving these again
+        self._resolved = set()
+        self._refresh_locks = {}
+        self._refresh_tasks = {}
+        self.stats = CacheStats()
+
+    #
+    # returns:  unexpired schedule ID for the gym, or None if it has to be resolved
+    #
+    def get(self, gym):
+        entry = self._entries.get(str(gym))
+        hit = entry is not None and entry.resolved_at > timezone.now() - self._ttl
+        self.stats.record(hit)
+        SCHEDULE_ID_CACHE_STATS.record(hit)
+        return entry.schedule_id if hit else None
+
+    #
+    # returns:  last known schedule ID for the gym, expired or not (None if there's none)
+    #
+    def get_previous(self, gym):
+        entry = self._entries.get(str(gym))
+        return entry.schedule_id if entry else None
+
+    def store(self, gym, schedule_id):
+        with self._lock:
+            self._entries[str(gym)] = MindBodyScheduleId(gym=gym, schedule_id=schedule_id, resolved_at=timezone.now())
+            self._resolved.add(str(gym))
+
+    #
+    # Replace a schedule ID the widget endpoint rejected
+    #
+    # params:
+    # gym:  gym whose schedule ID failed
+    # failed_id:  the ID that failed
+    # resolve:  function returning a freshly resolved schedule ID
+    #
+    # returns:  the new schedule ID, or None if it was already resolved this run (the error isn't a stale ID)
+    #
+    def refresh(self, gym, failed_id, resolve):
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault(str(gym), threading.Lock())
+        # Days failing together share one resolution
+        with refresh_lock:
+            if str(gym) not in self._resolved:
+                logger.info("SCHEDULE ID {} FOR {} REJECTED, RESOLVING".format(failed_id, gym))
+                self.store(gym, resolve())
+        return self._get_replacement(gym, failed_id)
+
+    async def refresh_async(self, gym, failed_id, resolve):
+        if str(gym) not in self._refresh_tasks:
+            self._refresh_tasks[str(gym)] = asyncio.ensure_future(self._resolve_async(gym, failed_id, resolve))
+        await self._refresh_tasks[str(gym)]
+        return self._get_replacement(gym, failed_id)
+
+    async def _resolve_async(self, gym, failed_id, resolve):
+        if str(gym) not in self._resolved:
+            logger.info("SCHEDULE ID {} FOR {} REJECTED, RESOLVING".format(failed_id, gym))
+            self.store(gym, await resolve())
+
+    def _get_replacement(self, gym, failed_id):
+        current_id = self._entries[str(gym)].schedule_id
+        return current_id if current_id != failed_id else None
+
+    def flush(self):
+        with self._lock:
+            resolved = [self._entries[gym] for gym in self._resolved]
+        with transaction.atomic():
+            MindBodyScheduleId.objects.filter(gym__in=[entry.gym for entry in resolved]).delete()
+            MindBodyScheduleId.objects.bulk_create(resolved)
+        logger.info("SCHEDULE ID CACHE:  {}".format(self.stats))
 
 
 #
 # Scrape class data from gyms that use zencalendar
 #
+# The calendar is requested in week view, so one page covers up to seven days; each week page is fetched once
+# and every requested day is read out of it.
+#
 # params:
 # gym_location:  string representing gym location ("Castle Rock", etc.)
 # webpage_location:  calendar webpage URL
-# added_class_list:  reference to list of classes found over all gyms so far, function adds to this
+# first_date:  first day to retrieve
+# total_days:  number of days to retrieve
+# detail_cache:  optional ZenClassDetailCache for the gym, used to skip class info page fetches
 #
-def get_calendar_daily_data(gym_location, webpage_location, first_date, total_days=1):
+# returns:  list of classes found
+#
+def get_calendar_daily_data(gym_location, webpage_location, first_date, total_days=1, detail_cache=None):
+
+    class_list = []
+    for week_dates in get_calendar_weeks(first_date, total_days):
+        class_list.extend(get_calendar_week_data(gym_location, webpage_location, week_dates, detail_cache).classes)
+    return class_list
+
+
+#
+# Split a range of days into calendar weeks (Sunday - Saturday, same as the zencalendar week view)
+#
+# returns:  list of lists of dates, one list per week
+#
+def get_calendar_weeks(first_date, total_days):
 
-    # TODO don't requery calendar page every day, it isn't necessary
+    weeks = []
     for day_number in range(total_days):
-        date_string = (first_date + timedelta(days=day_number)).strftime("%Y-%m-%d")
-        easton_request = Request(webpage_location+"?DATE="+date_string+"&VIEW=WEEK", headers={'User-Agent': 'lmccrone'})
-        schedule = urlopen(easton_request)
-        soup = BeautifulSoup(schedule.read())
-        day_schedule = soup.find('div', {'date': date_string})
-        calendar_classes = day_schedule.find_all('div', {'class': 'item'})
-        # strip string "calendar.cfm" (12 chars)
-        webpage_base = webpage_location[:-12]
-        for calendar_class in calendar_classes:
+        date = first_date + timedelta(days=day_number)
+        # isoweekday:  Sunday is 7, so Sunday starts a new week
+        if not weeks or date.isoweekday() == 7:
+            weeks.append([])
+        weeks[-1].append(date)
+    return weeks
+
+
+#
+# Scrape the given days (all in one calendar week) from a zencalendar gym, see get_calendar_daily_data
+#
+# returns:  ScrapedBatch
+#
+def get_calendar_week_data(gym_location, webpage_location, week_dates, detail_cache=None, page_hashes=None):
+
+    with gym_label(gym_location):
+        conditional = is_calendar_week_stored(gym_location, week_dates, page_hashes)
+        first_page = fetch_calendar_page(webpage_location, week_dates[0].strftime("%Y-%m-%d"), conditional)
+        first_page_items, page_hash = parse_changed_calendar_week(gym_location, week_dates, first_page, page_hashes)
+        day_pages = {date_string: fetch_calendar_page(webpage_location, date_string, conditional)
+                     for date_string in get_missing_calendar_days(week_dates, first_page_items)}
+        week_items = get_calendar_week_items(week_dates, first_page_items, day_pages)
+        week_class_list = []
+        for date_string, calendar_items in week_items:
+            for calendar_item in calendar_items or []:
+                def fetch_class_time():
+                    # Class info pages are too small to be worth sending to PARSE_POOL
+                    return parse_class_time(fetch(get_class_info_request_str(webpage_location, calendar_item)))
+                class_time = detail_cache.get_class_time(date_string, calendar_item, fetch_class_time) \
+                    if detail_cache else fetch_class_time()
+                week_class_list.append(build_calendar_class(gym_location, date_string, calendar_item, class_time))
+        classify_classes(week_class_list)
+        if page_hash is not None:
+            page_hashes.store(gym_location, week_dates[0], week_dates[-1], page_hash, week_class_list)
+        return get_week_batch(gym_location, week_dates, week_items, week_class_list)
+
+
+async def get_calendar_week_data_async(fetcher, gym_location, webpage_location, week_dates, detail_cache=None,
+                                       page_hashes=None):
+
+    with gym_label(gym_location):
+        conditional = is_calendar_week_stored(gym_location, week_dates, page_hashes)
+
+        async def fetch_calendar_pages(date_strings):
+            pages = await asyncio.gather(*[fetcher.fetch(get_calendar_request_str(webpage_location, date_string),
+                                                         headers=EASTON_REQUEST_HEADERS, conditional=conditional,
+                                                         store_validators=True)
+                                           for date_string in date_strings])
+            return dict(zip(date_strings, pages))
+
+        # Parsing is CPU-bound, keep it off the event loop
+        first_date_string = week_dates[0].strftime("%Y-%m-%d")
+        first_page = (await fetch_calendar_pages([first_date_string]))[first_date_string]
+        first_page_items, page_hash = await asyncio.to_thread(parse_changed_calendar_week, gym_location, week_dates,
+                                                              first_page, page_hashes)
+        day_pages = await fetch_calendar_pages(get_missing_calendar_days(week_dates, first_page_items))
+        week_items = await asyncio.to_thread(get_calendar_week_items, week_dates, first_page_items, day_pages)
+
+        calendar_entries = [(date_string, calendar_item) for date_string, calendar_items in week_items
+                            for calendar_item in calendar_items or []]
+        class_times = [detail_cache.lookup(date_string, calendar_item) if detail_cache else None
+                       for date_string, calendar_item in calendar_entries]
+        # Class detail pages are independent, fetch all the uncached ones at once
+        missing_entries = [entry for entry, class_time in zip(calendar_entries, class_times) if class_time is None]
+        class_info_pages = await asyncio.gather(
+            *[fetcher.fetch(get_class_info_request_str(webpage_location, calendar_item))
+              for date_string, calendar_item in missing_entries])
+
+        def build_week_batch():
+            fetched_times = {}
+            for (date_string, calendar_item), class_info_page in zip(missing_entries, class_info_pages):
+                fetched_times[calendar_item] = parse_class_time(class_info_page)
+                if detail_cache:
+                    detail_cache.store(date_string, calendar_item, fetched_times[calendar_item])
+            week_class_list = [build_calendar_class(gym_location, date_string, calendar_item,
+                                                    class_time if class_time is not None
+                                                    else fetched_times[calendar_item])
+                               for (date_string, calendar_item), class_time in zip(calendar_entries, class_times)]
+            classify_classes(week_class_list)
+            if page_hash is not None:
+                page_hashes.store(gym_location, week_dates[0], week_dates[-1], page_hash, week_class_list)
+            return get_week_batch(gym_location, week_dates, week_items, week_class_list)
+        return await asyncio.to_thread(build_week_batch)
+
+
+# Days read in full (see get_calendar_week_items) are the ones to reconcile
+def get_week_batch(gym_location, week_dates, week_items, week_class_list):
+    return ScrapedBatch(gym_location, [date for date, (_, calendar_items) in zip(week_dates, week_items)
+                                       if calendar_items is not None], week_class_list)
+
+
+#
+# Parse a zencalendar week page, unless it's unchanged:  not modified (None), or its hash shows it's the same as
+# when it was last stored (see PageHashCache)
+#
+# returns:  (parse_calendar_week result, or None if unchanged; the page's hash to store, or None)
+#
+def parse_changed_calendar_week(gym_location, week_dates, html, page_hashes=None):
+    if html is None:
+        return None, None
+    if page_hashes is None:
+        return PARSE_POOL.run(parse_calendar_week, html), None
+    page_hash = page_hashes.get_page_hash(html)
+    if page_hashes.is_unchanged(gym_location, week_dates[0], week_dates[-1], page_hash):
+        return None, None
+    return PARSE_POOL.run(parse_calendar_week, html), page_hash
+
+
+#
+# Read the listed classes for each of the given days from zencalendar week pages
+#
+# The week page for the first day normally covers every day.  A day missing from it (if the site's week
+# boundaries ever differ from get_calendar_weeks) is read from its own week page instead.  Pages of a stored week
+# are fetched conditionally; an unchanged page (None) means its days were already stored, so they come back as None.
+#
+# params:
+# week_dates:  days to read
+# first_page_items:  parse_calendar_week result for the first day's week page, or None if unchanged
+# day_pages:  dict of date string -> week page html (or None if unchanged), for get_missing_calendar_days
+#
+# returns:  list of (date string, list of ZenCalendarItem, or None if the day is unchanged or wasn't found)
+#
+def get_calendar_week_items(week_dates, first_page_items, day_pages):
+
+    date_strings = [date.strftime("%Y-%m-%d") for date in week_dates]
+    if first_page_items is None:
+        logger.info("CALENDAR WEEK {} UNCHANGED".format(date_strings[0]))
+        return [(date_string, None) for date_string in date_strings]
+
+    week_items = dict(first_page_items)
+    for date_string, day_page in day_pages.items():
+        if day_page is None:
+            week_items[date_string] = None
+            continue
+        day_items = PARSE_POOL.run(parse_calendar_week, day_page)
+        if date_string not in day_items:
+            logger.warning("NO CALENDAR DAY {}".format(date_string))
+        week_items[date_string] = day_items.get(date_string)
+    return [(date_string, week_items[date_string]) for date_string in date_strings]
+
+
+#
+# returns:  date strings of the days not covered by the first day's week page (none if it was unchanged)
+#
+def get_missing_calendar_days(week_dates, first_page_items):
+    if first_page_items is None:
+        return []
+    return [date.strftime("%Y-%m-%d") for date in week_dates if date.strftime("%Y-%m-%d") not in first_page_items]
+
+
+# The week's pages are fetched conditionally only if a 304 would mean its classes are stored, see PageHashCache
+def is_calendar_week_stored(gym_location, week_dates, page_hashes):
+    return page_hashes is not None and page_hashes.is_stored(gym_location, week_dates[0], week_dates[-1])
+
+
+def fetch_calendar_page(webpage_location, date_string, conditional):
+    return fetch(get_calendar_request_str(webpage_location, date_string), headers=EASTON_REQUEST_HEADERS,
+                 conditional=conditional, store_validators=True)
+
+
+def get_calendar_request_str(webpage_location, date_string):
+    return webpage_location + "?DATE=" + date_string + "&VIEW=WEEK"
+
+
+def get_class_info_request_str(webpage_location, calendar_item):
+    # strip string "calendar.cfm" (12 chars)
+    return webpage_location[:-12] + calendar_item.class_link_query
+
+
+#
+# Find the classes listed for each day on a zencalendar week page
+#
+# returns:  dict of date string ("%Y-%m-%d") -> list of ZenCalendarItem
+#
+@timed('parse')
+def parse_calendar_week(html):
+
+    soup = make_soup(html, CALENDAR_DAY_STRAINER)
+    week_items = {}
+    for day_schedule in soup.find_all('div', {'date': True}):
+        calendar_items = []
+        for calendar_class in day_schedule.find_all('div', {'class': 'item'}):
 
             # Class info URL query is in single quotes in 'onclick' attribute
             # FORMAT:  onclick="checkLoggedId('enrollment.cfm?appointmentId=<id>')"
             class_link_attr = calendar_class.get('onclick')
-            logger.info("CLASS LINK ATTR: " + class_link_attr)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("CLASS LINK ATTR: " + class_link_attr)
             class_link_query = class_link_attr.split('\'')[1]
             class_id = class_link_query.split('?')[1].split('=')[1]
-            class_info_request = Request(webpage_base + class_link_query)
-            class_info = urlopen(class_info_request)
-            class_soup = BeautifulSoup(class_info.read())
-            class_rows = class_soup.find_all('tr')
-            class_time = ""
-            for class_row in class_rows:
-                if class_row.find('td').text == 'Time':
-                    class_time = class_row.find('td', {'class': 'bold'}).text
-                    break
+            calendar_items.append(ZenCalendarItem(class_id, class_link_query, calendar_class.get('class')[2],
+                                                  calendar_class.text))
+        week_items[day_schedule['date']] = calendar_items
+    return week_items
 
-            easton_class = EastonClass()
-            easton_class.gym = gym_location
-            easton_class.category = calendar_class.get('class')[2]
-            easton_class.class_id = class_id
-            easton_class.name = calendar_class.text
-            easton_class.date = date_string
-            class_time_list = class_time.split(" - ")
-            start_time = class_time_list[0]
-            end_time = class_time_list[1]
-            easton_class.start_time = datetime.strptime(
-                easton_class.date + ' ' + start_time, '%Y-%m-%d %I:%M %p')
-            easton_class.start_time.astimezone(pytz.timezone('US/Mountain'))
-            easton_class.end_time = datetime.strptime(
-                easton_class.date + ' ' + end_time, '%Y-%m-%d %I:%M %p')
-            easton_class.end_time.astimezone(pytz.timezone('US/Mountain'))
-            get_list_category(easton_class)
-
-            insert_or_update(easton_class)
-
-
-def get_classes(gym_list, class_type_list, requirements_list):
-
-    query_sets = []
-    for gym_query in gym_list:
-        for class_type_query in class_type_list:
-            for requirements_query in requirements_list:
-                try:
-                    query_sets.extend([easton_class for easton_class in
-                                       EastonClass.objects.filter(gym=EastonGym[gym_query],
-                                                                  category=EastonClassCategory[class_type_query],
-                                                                  requirements=EastonRequirements[requirements_query])])
-                except EastonClass.DoesNotExist:
-                    continue
-    return query_sets
 
+#
+# Read the class time (FORMAT:  "<start> - <end>") from a zencalendar class info page
+#
+@timed('parse')
+def parse_class_time(html):
+
+    class_soup = make_soup(html, TABLE_ROW_STRAINER)
+    class_rows = class_soup.find_all('tr')
+    class_time = ""
+    for class_row in class_rows:
+        if class_row.find('td').text == 'Time':
+            class_time = class_row.find('td', {'class': 'bold'}).text
+            break
+    return class_time
+
+
+def build_calendar_class(gym_location, date_string, calendar_item, class_time):
+
+    easton_class = EastonClass()
+    easton_class.gym = gym_location
+    easton_class.category = calendar_item.category
+    easton_class.class_id = calendar_item.class_id
+    easton_class.name = calendar_item.name
+    easton_class.date = date_string
+    class_time_list = class_time.split(" - ")
+    start_time = class_time_list[0]
+    end_time = class_time_list[1]
+    easton_class.start_time = datetime.strptime(
+        easton_class.date + ' ' + start_time, '%Y-%m-%d %I:%M %p')
+    easton_class.start_time.astimezone(pytz.timezone('US/Mountain'))
+    easton_class.end_time = datetime.strptime(
+        easton_class.date + ' ' + end_time, '%Y-%m-%d %I:%M %p')
+    easton_class.end_time.astimezone(pytz.timezone('US/Mountain'))
+    return easton_class
 
-def get_list_category(easton_class):
 
-    c = easton_class.mindbody_category.lower() if easton_class.mindbody_category else ""
-    n = easton_class.name.lower()
-
-    # Little tigers
-    if ("youth bjj" in c and "lil yeti" in n) or \
-            ("little tigers" in c) or \
-            (not c and "little tigers" in n):
-        easton_class.category = EastonClassCategory.LTS
-        easton_class.requirements = EastonRequirements.NON
-
-    # Kids bjj, wrestling
-    elif "youth bjj" in c:
-        easton_class.category = EastonClassCategory.KBJ
-        if "yeti" in n:
-            easton_class.requirements = EastonRequirements.NON
-        else:
-            easton_class.requirements = EastonRequirements.YBL
-    elif "kids" in c and "tiger" not in c:
-        easton_class.category = EastonClassCategory.KBJ
-        if "advanced" in n:
-            easton_class.requirements = EastonRequirements.SGB
-        elif "wrestling for youth" in n:
-            easton_class.category = EastonClassCategory.KWR
-            easton_class.requirements = EastonRequirements.NON
-        else:
-            easton_class.requirements = EastonRequirements.NON
-    elif "tigers" in c or (not c and ("kids martial arts" in n or "tiger" in n)):
-        easton_class.category = EastonClassCategory.KBJ
-        if "invite-only" in n:
-            easton_class.requirements = EastonRequirements.INV
-        elif "advanced" in n or \
-                "competition" in n:
-            easton_class.requirements = EastonRequirements.SGB
-        elif "comp" in n:
-            easton_class.requirements = EastonRequirements.GWB
-        else:
-            easton_class.requirements = EastonRequirements.NON
-    elif "seminar" in c and "kids" in n:
-        easton_class.category = EastonClassCategory.KBJ
-        easton_class.requirements = EastonRequirements.NON
-    elif not c and "kids competition" in n:
-        easton_class.category = EastonClassCategory.KBJ
-        easton_class.requirements = EastonRequirements.YBL
-    elif not c and "tigers" in n:
-        easton_class.category = EastonClassCategory.KBJ
-        easton_class.requirements = EastonRequirements.NON
-    elif not c and "teen bjj" in n:
-        easton_class.category = EastonClassCategory.KBJ
-        easton_class.requirements = EastonRequirements.INV
-
-    # Kids muay thai
-    elif "kids muay thai" in c or "youth kick" in c:
-        easton_class.category = EastonClassCategory.KST
-        easton_class.requirements = EastonRequirements.NON
-    elif not c and "kids muay thai" in n:
-        easton_class.category = EastonClassCategory.KST
-        easton_class.requirements = EastonRequirements.NON
-
-    # Adult BJJ, wrestling, yoga, MMA (MMA also below)
-    elif "bjj" in c or \
-         (not c and ("bjj" in n and not "tiger" in n)):
-        # I put some of these into different categories.  Split them off first.
-        if "wrestling" in n:
-            easton_class.category = EastonClassCategory.WRE
-            easton_class.requirements = EastonRequirements.TSW
-        elif "yoga" in n:
-            easton_class.category = EastonClassCategory.YOG
-            easton_class.requirements = EastonRequirements.NON
-        elif "mma" in n:
-            easton_class.category = EastonClassCategory.MMA
-            easton_class.requirements = EastonRequirements.GFS
-        else:
-            easton_class.category = EastonClassCategory.BJJ
-            if "beware" in n:
-                easton_class.requirements = EastonRequirements.PBT
-            elif "advanced" in n:
-                easton_class.requirements = EastonRequirements.BBT
-            elif "randori" in n:
-                if "all levels" in n:
-                    easton_class.requirements = EastonRequirements.NON
-                elif "160" in n:
-                    easton_class.requirements = EastonRequirements.TSU
-                elif "40" in n:
-                    easton_class.requirements = EastonRequirements.OFY
-                else:
-                    easton_class.requirements = EastonRequirements.WTS
-            elif "competition training" in n:
-                easton_class.requirements = EastonRequirements.WTS
-            elif "adv/int" in n or \
-                    ("intermediate" in n and "fundamentals" not in n):
-                easton_class.requirements = EastonRequirements.WTS
-            elif "200" in n:
-                easton_class.requirements = EastonRequirements.OTH
-            elif "women" in n:
-                easton_class.requirements = EastonRequirements.FEM
-            # TODO set c and n to lowercase
-            elif "flow roll" in n or \
-                "fundamentals" in n or \
-                    "family" in n or \
-                    "all levels" in n or \
-                    "all-levels" in n or \
-                    "intro" in n or "int/fund" in n:
-                 easton_class.requirements = EastonRequirements.NON
-    elif not c and ("randori" in n or "bjj" in n or "no-gi" in n or "no gi" in n or "drilling" in n):
-        easton_class.category = EastonClassCategory.BJJ
-        if "advanced" in easton_class.name:
-            easton_class.requirements = EastonRequirements.BBT
-        elif ("intermediate" in easton_class.name and "fundamentals" not in easton_class.name) or \
-                "randori" in easton_class.name:
-            easton_class.requirements = EastonRequirements.WTS
-        elif "all levels" in easton_class.name or \
-                "fundamentals" in easton_class.name or \
-                "no gi" in easton_class.name or \
-                "no-gi" in easton_class.name or \
-                "family" in easton_class.name or \
-                "drilling" in easton_class.name:
-            easton_class.requirements = EastonRequirements.NON
-
-    # Conditioning
-    elif "conditioning" in c:
-        easton_class.category = EastonClassCategory.CON
-        easton_class.requirements = EastonRequirements.NON
-
-    # Open gym
-    elif "open gym" in c or "open mat" in c:
-        easton_class.category = EastonClassCategory.OGY
-        easton_class.requirements = EastonRequirements.NON
-
-    # Adult muay thai
-    elif "muay thai" in c or "striking" in c:
-        easton_class.category = EastonClassCategory.STR
-        if "blue shirt" in n:
-            easton_class.requirements = EastonRequirements.BSH
-        elif "competition" in n or "sparring" in n or "green shirt" in n:
-            easton_class.requirements = EastonRequirements.GSH
-        elif "advanced" in n or "intermediate" in n or "orange shirt" in n:
-            easton_class.requirements = EastonRequirements.OSH
-        elif "muay thai" in n or \
-             "thai pad" in n or \
-             "clinch" in n:
-            easton_class.requirements = EastonRequirements.YSH
-        elif "kickboxing" in n or \
-             "open mat" in n or \
-             "fundamentals of striking" in n or \
-             "teens" in n:
-            easton_class.requirements = EastonRequirements.NON
-        elif "invite only" in n:
-            easton_class.requirements = EastonRequirements.INV
-    elif not c and ("muay thai" in n or "kickboxing" in n):
-        easton_class.category = EastonClassCategory.STR
-        if "Muay Thai" in easton_class.name:
-            easton_class.requirements = EastonRequirements.YSH
-        elif "Kickboxing" in easton_class.name:
-            easton_class.requirements = EastonRequirements.NON
+#
+# params:
+# gym_list, class_type_list, requirements_list:  enum member names (e.g. "AR", "BJJ", "NON") to match
+# start_time, end_time:  optional window, classes starting at or after start_time and before end_time
+#
+# returns:  one queryset for every combination, canceled classes left out, ordered by start time (then ID, so
+# pages are stable) in the database (see eastonclass_search_idx)
+#
+def get_classes(gym_list, class_type_list, requirements_list, start_time=None, end_time=None):
 
+    query_set = EastonClass.objects.filter(gym__in=[EastonGym[gym] for gym in gym_list],
+                                           category__in=[EastonClassCategory[class_type]
+                                                         for class_type in class_type_list],
+                                           requirements__in=[EastonRequirements[requirements]
+                                                             for requirements in requirements_list],
+                                           canceled=False)
+    if start_time is not None:
+        query_set = query_set.filter(start_time__gte=start_time)
+    if end_time is not None:
+        query_set = query_set.filter(start_time__lt=end_time)
+    return query_set.order_by('start_time', 'id')
 
 
-    # MMA
-    elif "pro fight team" in c:
-        easton_class.category = EastonClassCategory.MMA
-        easton_class.requirements = EastonRequirements.INV
+#
+# Keyset pagination over a get_classes queryset
+#
+# after:  (start_time, id) of the last class on the previous page, or None for the first page
+# returns:  (list of up to page_size classes, (start_time, id) to pass as 'after' for the next page, or None if
+# this is the last page)
+#
+def get_class_page(query_set, page_size, after=None):
+
+    if after is not None:
+        start_time, class_pk = after
+        query_set = query_set.filter(start_time__gte=start_time).exclude(start_time=start_time, id__lte=class_pk)
+    page = list(query_set[:page_size + 1])
+    if len(page) <= page_size:
+        return page, None
+    last_class = page[page_size - 1]
+    return page[:page_size], (last_class.start_time, last_class.id)
+
+
+#
+# Class category and requirements, from a MindBody group header ("Adult BJJ", etc.) and class name
+#
+# A rule matches when every test it's given passes:
+# in_category, in_name, in_raw_name:  any of these keywords is in the lowercased header, the lowercased name, or
+#     the name as listed
+# not_in_category, not_in_name, not_in_raw_name:  none of these keywords are
+# no_category:  the class has no header (zencalendar classes, MindBody classes listed before any header)
+#
+# A matching rule sets category and requirements (None leaves them as they are), then the first of its subrules
+# that matches is applied the same way.
+#
+ClassRule = namedtuple('ClassRule', ['tests', 'category', 'requirements', 'subrules'])
+
+CLASS_RULE_TESTS = ('in_category', 'in_name', 'in_raw_name', 'not_in_category', 'not_in_name', 'not_in_raw_name')
+
+
+def class_rule(category=None, requirements=None, subrules=(), no_category=False, **tests):
+    if set(tests) - set(CLASS_RULE_TESTS):
+        raise TypeError("Unknown class rule tests: {}".format(set(tests) - set(CLASS_RULE_TESTS)))
+    tests = {test: frozenset([keywords] if isinstance(keywords, str) else keywords)
+             for test, keywords in tests.items()}
+    if no_category:
+        tests['no_category'] = True
+    return ClassRule(tests, category, requirements, tuple(subrules))
+
+
+KIDS_TIGERS_SUBRULES = [
+    class_rule(in_name="invite-only", requirements=EastonRequirements.INV),
+    class_rule(in_name=("advanced", "competition"), requirements=EastonRequirements.SGB),
+    class_rule(in_name="comp", requirements=EastonRequirements.GWB),
+    class_rule(requirements=EastonRequirements.NON),
+]
+
+ADULT_BJJ_SUBRULES = [
+    # I put some of these into different categories.  Split them off first.
+    class_rule(in_name="wrestling", category=EastonClassCategory.WRE, requirements=EastonRequirements.TSW),
+    class_rule(in_name="yoga", category=EastonClassCategory.YOG, requirements=EastonRequirements.NON),
+    class_rule(in_name="mma", category=EastonClassCategory.MMA, requirements=EastonRequirements.GFS),
+    class_rule(category=EastonClassCategory.BJJ, subrules=[
+        class_rule(in_name="beware", requirements=EastonRequirements.PBT),
+        class_rule(in_name="advanced", requirements=EastonRequirements.BBT),
+        class_rule(in_name="randori", subrules=[
+            class_rule(in_name="all levels", requirements=EastonRequirements.NON),
+            class_rule(in_name="160", requirements=EastonRequirements.TSU),
+            class_rule(in_name="40", requirements=EastonRequirements.OFY),
+            class_rule(requirements=EastonRequirements.WTS),
+        ]),
+        class_rule(in_name="competition training", requirements=EastonRequirements.WTS),
+        class_rule(in_name="adv/int", requirements=EastonRequirements.WTS),
+        class_rule(in_name="intermediate", not_in_name="fundamentals", requirements=EastonRequirements.WTS),
+        class_rule(in_name="200", requirements=EastonRequirements.OTH),
+        class_rule(in_name="women", requirements=EastonRequirements.FEM),
+        class_rule(in_name=("flow roll", "fundamentals", "family", "all levels", "all-levels", "intro", "int/fund"),
+                   requirements=EastonRequirements.NON),
+    ]),
+]
+
+# Applied in order, the first matching rule of each list wins and later lists override earlier ones
+CLASS_RULES = [
+    [
+        # Little tigers
+        class_rule(in_category="youth bjj", in_name="lil yeti",
+                   category=EastonClassCategory.LTS, requirements=EastonRequirements.NON),
+        class_rule(in_category="little tigers", category=EastonClassCategory.LTS, requirements=EastonRequirements.NON),
+        class_rule(no_category=True, in_name="little tigers",
+                   category=EastonClassCategory.LTS, requirements=EastonRequirements.NON),
+
+        # Kids bjj, wrestling
+        class_rule(in_category="youth bjj", category=EastonClassCategory.KBJ, subrules=[
+            class_rule(in_name="yeti", requirements=EastonRequirements.NON),
+            class_rule(requirements=EastonRequirements.YBL),
+        ]),
+        class_rule(in_category="kids", not_in_category="tiger", category=EastonClassCategory.KBJ, subrules=[
+            class_rule(in_name="advanced", requirements=EastonRequirements.SGB),
+            class_rule(in_name="wrestling for youth",
+                       category=EastonClassCategory.KWR, requirements=EastonRequirements.NON),
+            class_rule(requirements=EastonRequirements.NON),
+        ]),
+        class_rule(in_category="tigers", category=EastonClassCategory.KBJ, subrules=KIDS_TIGERS_SUBRULES),
+        class_rule(no_category=True, in_name=("kids martial arts", "tiger"),
+                   category=EastonClassCategory.KBJ, subrules=KIDS_TIGERS_SUBRULES),
+        class_rule(in_category="seminar", in_name="kids",
+                   category=EastonClassCategory.KBJ, requirements=EastonRequirements.NON),
+        class_rule(no_category=True, in_name="kids competition",
+                   category=EastonClassCategory.KBJ, requirements=EastonRequirements.YBL),
+        class_rule(no_category=True, in_name="tigers",
+                   category=EastonClassCategory.KBJ, requirements=EastonRequirements.NON),
+        class_rule(no_category=True, in_name="teen bjj",
+                   category=EastonClassCategory.KBJ, requirements=EastonRequirements.INV),
+
+        # Kids muay thai
+        class_rule(in_category=("kids muay thai", "youth kick"),
+                   category=EastonClassCategory.KST, requirements=EastonRequirements.NON),
+        class_rule(no_category=True, in_name="kids muay thai",
+                   category=EastonClassCategory.KST, requirements=EastonRequirements.NON),
+
+        # Adult BJJ, wrestling, yoga, MMA (MMA also below)
+        class_rule(in_category="bjj", subrules=ADULT_BJJ_SUBRULES),
+        class_rule(no_category=True, in_name="bjj", not_in_name="tiger", subrules=ADULT_BJJ_SUBRULES),
+        # zencalendar names are matched as listed here
+        class_rule(no_category=True, in_name=("randori", "bjj", "no-gi", "no gi", "drilling"),
+                   category=EastonClassCategory.BJJ, subrules=[
+            class_rule(in_raw_name="advanced", requirements=EastonRequirements.BBT),
+            class_rule(in_raw_name="intermediate", not_in_raw_name="fundamentals",
+                       requirements=EastonRequirements.WTS),
+            class_rule(in_raw_name="randori", requirements=EastonRequirements.WTS),
+            class_rule(in_raw_name=("all levels", "fundamentals", "no gi", "no-gi", "family", "drilling"),
+                       requirements=EastonRequirements.NON),
+        ]),
+
+        # Conditioning
+        class_rule(in_category="conditioning", category=EastonClassCategory.CON, requirements=EastonRequirements.NON),
+
+        # Open gym
+        class_rule(in_category=("open gym", "open mat"),
+                   category=EastonClassCategory.OGY, requirements=EastonRequirements.NON),
+
+        # Adult muay thai
+        class_rule(in_category=("muay thai", "striking"), category=EastonClassCategory.STR, subrules=[
+            class_rule(in_name="blue shirt", requirements=EastonRequirements.BSH),
+            class_rule(in_name=("competition", "sparring", "green shirt"), requirements=EastonRequirements.GSH),
+            class_rule(in_name=("advanced", "intermediate", "orange shirt"), requirements=EastonRequirements.OSH),
+            class_rule(in_name=("muay thai", "thai pad", "clinch"), requirements=EastonRequirements.YSH),
+            class_rule(in_name=("kickboxing", "open mat", "fundamentals of striking", "teens"),
+                       requirements=EastonRequirements.NON),
+            class_rule(in_name="invite only", requirements=EastonRequirements.INV),
+        ]),
+        class_rule(no_category=True, in_name=("muay thai", "kickboxing"), category=EastonClassCategory.STR, subrules=[
+            class_rule(in_raw_name="Muay Thai", requirements=EastonRequirements.YSH),
+            class_rule(in_raw_name="Kickboxing", requirements=EastonRequirements.NON),
+        ]),
+
+        # MMA
+        class_rule(in_category="pro fight team", category=EastonClassCategory.MMA, requirements=EastonRequirements.INV),
+    ],
 
     # Fitness
-    if not c and "fitness" in n:
-        easton_class.category = EastonClassCategory.CON
-        easton_class.requirements = EastonRequirements.NON
+    [class_rule(no_category=True, in_name="fitness", category=EastonClassCategory.CON,
+                requirements=EastonRequirements.NON)],
 
     # Private lesson
-    if not c and "private lesson" in n:
-        easton_class.category = EastonClassCategory.PLE
-        easton_class.requirements = EastonRequirements.NON
+    [class_rule(no_category=True, in_name="private lesson", category=EastonClassCategory.PLE,
+                requirements=EastonRequirements.NON)],
+]
+
+
+#
+# Canonical text of a list of rule lists:  every test (keywords sorted), outcome and subrule, the same in every
+# process for the same rules
+#
+def dump_class_rules(rule_lists):
+
+    def dump_rule(rule):
+        tests = ", ".join("{}={}".format(test, sorted(keywords) if test != 'no_category' else keywords)
+                          for test, keywords in sorted(rule.tests.items()))
+        return "rule({}; category={}, requirements={}; [{}])".format(
+            tests, rule.category, rule.requirements, ", ".join(dump_rule(subrule) for subrule in rule.subrules))
+    return "\n".join("[{}]".format(", ".join(dump_rule(rule) for rule in rules)) for rules in rule_lists)
+
+
+#
+# CLASS_RULES compiled into one classification function
+#
+# The rules are turned into nested if/elif blocks of substring tests, generated and compiled once, so a class is
+# classified in a single pass that costs the same as a hand-written if/elif chain.  Each string is lowercased once,
+# and each rule list stops at its first match.  The generated source (kept in source, and shown in tracebacks as
+# CLASS_RULES_FILE_NAME) names outcomes, e.g. "category = EastonClassCategory.BJJ", and has two functions:
+# classify(), returning them, and classify_class(), setting them on the class.
+#
+# The same class names come up every day at every gym, so results are memoized on (MindBody header, name) in an
+# LRU cache of max_entries.  Loading new rules clears it.
+#
+class ClassClassifier:
+
+    def __init__(self, rule_lists, max_entries=None):
+        self._max_entries = max_entries or getattr(settings, 'SCRAPER_CLASSIFICATION_CACHE_SIZE',
+                                                   DEFAULT_CLASSIFICATION_CACHE_SIZE)
+        self.load_rules(rule_lists)
+
+    def load_rules(self, rule_lists):
+        self.rules_text = dump_class_rules(rule_lists)
+        lines = ["def classify(mindbody_category, raw_name):",
+                 "    category_text = mindbody_category.lower() if mindbody_category else ''",
+                 "    name_text = raw_name.lower()",
+                 "    category = requirements = None"]
+        for rules in rule_lists:
+            self._add_rules(lines, rules, 1, "")
+        lines.append("    return category, requirements")
+        # The same, setting the class's fields rather than returning them
+        lines += ["",
+                  "",
+                  "def classify_class(easton_class):",
+                  "    raw_name = easton_class.name",
+                  "    category_text = easton_class.mindbody_category",
+                  "    category_text = category_text.lower() if category_text else ''",
+                  "    name_text = raw_name.lower()"]
+        for rules in rule_lists:
+            self._add_rules(lines, rules, 1, "easton_class.")
+        self.source = "\n".join(lines) + "\n"
+        namespace = {'EastonClassCategory': EastonClassCategory, 'EastonRequirements': EastonRequirements}
+        exec(compile(self.source, CLASS_RULES_FILE_NAME, 'exec'), namespace)
+        # So tracebacks through the generated function show its lines
+        linecache.cache[CLASS_RULES_FILE_NAME] = (len(self.source), None, self.source.splitlines(True),
+                                                  CLASS_RULES_FILE_NAME)
+        self.match = namespace['classify']
+        self.match_class = namespace['classify_class']
+
+        # A new cache rather than cache_clear(), so a classify() racing with this can't cache an old result
+        self._classify = lru_cache(maxsize=self._max_entries)(self.match)
+
+    #
+    # returns:  (category, requirements), either None if no rule sets it
+    #
+    # match(mindbody_category, name) is the same without the memo, and match_class(easton_class) sets the class's
+    # category and requirements from it.
+    #
+    def classify(self, mindbody_category, name):
+        return self._classify(mindbody_category, name)
+
+    # functools.lru_cache statistics (hits, misses, maxsize, currsize) since the rules were loaded
+    def cache_info(self):
+        return self._classify.cache_info()
+
+    def _add_rules(self, lines, rules, depth, target):
+        indent = "    " * depth
+        for rule_number, rule in enumerate(rules):
+            condition = self._get_condition(rule)
+            if condition is None:
+                lines.append("{}{}:".format(indent, "if True" if rule_number == 0 else "else"))
+            else:
+                lines.append("{}{} {}:".format(indent, "if" if rule_number == 0 else "elif", condition))
+            body_length = len(lines)
+            if rule.category is not None:
+                lines.append("{}    {}category = {}".format(indent, target, get_enum_name(rule.category)))
+            if rule.requirements is not None:
+                lines.append("{}    {}requirements = {}".format(indent, target, get_enum_name(rule.requirements)))
+            self._add_rules(lines, rule.subrules, depth + 1, target)
+            if len(lines) == body_length:
+                lines.append("{}    pass".format(indent))
+
+    TEST_TEXT = {'category': 'category_text', 'name': 'name_text', 'raw_name': 'raw_name'}
+
+    def _get_condition(self, rule):
+        conditions = []
+        if rule.tests.get('no_category'):
+            conditions.append("not category_text")
+        for test in CLASS_RULE_TESTS:
+            if test not in rule.tests:
+                continue
+            negated = test.startswith('not_')
+            text = self.TEST_TEXT[test[len('not_in_' if negated else 'in_'):]]
+            any_keyword = " or ".join("{!r} in {}".format(keyword, text)
+                                      for keyword in sorted(rule.tests[test]))
+            conditions.append("not ({})".format(any_keyword) if negated else "({})".format(any_keyword))
+        return " and ".join(conditions) or None
+
+
+# EastonClassCategory.BJJ -> "EastonClassCategory.BJJ", as the generated classify function refers to it
+def get_enum_name(value):
+    return "{}.{}".format(type(value).__name__, value.name)
+
+
+CLASS_CLASSIFIER = ClassClassifier(CLASS_RULES)
+
+
+def get_list_category(easton_class):
+
+    category, requirements = CLASS_CLASSIFIER.classify(easton_class.mindbody_category, easton_class.name)
+    if category is not None:
+        easton_class.category = category
+    if requirements is not None:
+        easton_class.requirements = requirements
+
 
+# get_list_category for each of one page's (or week's) classes, timed as a single 'classify' observation
+@timed('classify')
+def classify_classes(easton_classes):
+    for easton_class in easton_classes:
+        get_list_category(easton_class)
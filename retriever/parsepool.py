@@ -0,0 +1,140 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import django
+import logging
+import multiprocessing
+import threading
+import time
+
+from .metrics import CURRENT_GYM, SCRAPE_METRICS
+
+logger = logging.getLogger('django')
+
+
+#
+# Process pool the threaded engine's fetch workers hand page parsing (and classification) to
+#
+# Parsing is CPU-bound, so on the fetch threads it only ever runs one page at a time, however many cores there are,
+# and holds up fetching while it does.  Inside use(), submit() queues the work for a pool of worker processes and
+# returns a future, so the fetch thread can go on to its next page; the queue holds at most queue_size pages, past
+# that submit() waits for room.  Outside use(), work runs inline.
+#
+# Tasks are module-level functions of picklable arguments (page bytes, enums, dates), returning picklable results.
+# Workers are spawned rather than forked (the scraper has threads and open connections by then) and set Django up
+# themselves, so they see settings.py but not settings overridden at runtime.  Spawning them and setting Django up
+# takes a while, so the worker processes are started by the first use() and kept for the life of the process;
+# later runs reuse them (a use() asking for a different number of processes replaces them).  Their own metrics
+# (classify timings, classification cache statistics) stay in their processes; only the time each task spent
+# queued and parsing is recorded here, as 'parse'.
+#
+class ParsePool:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Worker processes, kept between runs
+        self._executor = None
+        self._processes = 0
+        self._broken = False
+        # While in use():  the executor, and the queue slots
+        self._current = None
+        self._slots = None
+
+    @property
+    def active(self):
+        return self._current is not None
+
+    #
+    # returns:  Future of function(*args)
+    #
+    def submit(self, function, *args):
+        executor, slots = self._current, self._slots
+        if executor is None:
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        slots.acquire()
+        start = time.perf_counter()
+        gym = CURRENT_GYM.get()
+
+        def finished(future):
+            slots.release()
+            SCRAPE_METRICS.observe('parse', time.perf_counter() - start, gym)
+            if isinstance(future.exception(), BrokenProcessPool):
+                # A worker died; the next use() starts new ones
+                self._broken = True
+        try:
+            future = executor.submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(finished)
+        return future
+
+    # function(*args), waiting for the result
+    def run(self, function, *args):
+        if self._current is None:
+            return function(*args)
+        return self.submit(function, *args).result()
+
+    #
+    # Parse in processes worker processes until exit, with up to queue_size pages (default:  twice processes)
+    # queued or parsing; nested in another use(), keeps to the pool already in use
+    #
+    @contextmanager
+    def use(self, processes, queue_size=None):
+        if not processes or self._current is not None:
+            yield
+            return
+        self._slots = threading.BoundedSemaphore(queue_size or 2 * processes)
+        self._current = self._get_executor(processes)
+        try:
+            yield
+        finally:
+            self._current = None
+
+    # Stop the worker processes (the next use() starts new ones)
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _get_executor(self, processes):
+        with self._lock:
+            old_executor = None
+            if self._executor is None or self._processes != processes or self._broken:
+                old_executor = self._executor
+                self._executor = ProcessPoolExecutor(max_workers=processes,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=django.setup)
+                self._processes = processes
+                self._broken = False
+                logger.info("PARSE POOL:  {} PROCESSES".format(processes))
+            executor = self._executor
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+        return executor
+
+
+#
+# returns:  Future of function(future's result), or of future's exception
+#
+def chain_future(future, function):
+    chained = Future()
+
+    def finish(future):
+        try:
+            chained.set_result(function(future.result()))
+        except Exception as e:
+            chained.set_exception(e)
+    future.add_done_callback(finish)
+    return chained
+
+
+PARSE_POOL = ParsePool()
@@ -1,9 +1,13 @@
 from django.urls import path
-from retriever.views import get_raw_data, get_select_page, get_checks, retrieve_data
+from retriever.views import get_raw_data, get_select_page, get_checks, get_classes_json, get_metrics, \
+    get_scrape_status_page, retrieve_data
 
 urlpatterns = [
     path('rawdata/', get_raw_data),
     path('select/', get_select_page),
     path('get-checks/', get_checks),
-    path('retrieve/', retrieve_data)
+    path('classes.json', get_classes_json),
+    path('metrics/', get_metrics),
+    path('retrieve/', retrieve_data),
+    path('retrieve/status/', get_scrape_status_page)
 ]
@@ -1,7 +1,12 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.html import escape
+from django.utils import timezone
 from . import models
 from django.template import loader
 from bs4 import BeautifulSoup
+from collections import OrderedDict
 import logging
 from urllib.request import urlopen, Request
 from urllib.error import HTTPError, URLError
@@ -10,9 +15,20 @@ import time
 import pytz
 from enum import Enum
 import re
+import threading
 
 logger = logging.getLogger('django')
 
+# get_checks paging
+MAX_PAGE_SIZE = 500
+STREAM_CHUNK_SIZE = 500
+
+DEFAULT_RESPONSE_CACHE_SIZE = 256
+DEFAULT_RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+
+# EastonClass columns returned by get_classes_json
+CLASS_JSON_FIELDS = ['gym', 'class_id', 'name', 'category', 'requirements', 'start_time', 'end_time', 'canceled']
+
 
 def for_django(cls):
     cls.do_not_call_in_templates = True
@@ -175,10 +191,54 @@ class EastonClass:
         self.id = None
 
 
+#
+# Queue a scrape (see models.start_scrape_job) and return right away, with the job's status
+#
+# If a scrape is already queued or running, that one is returned instead of starting another.
+#
 def retrieve_data(request):
-    models.retrieve_data_from_web(models.NUMBER_RETRIEVAL_DAYS)
-    # NOTE:  let django return error if there's a failure
-    return HttpResponse("<html><title>Success</title><body>{}</body></html>".format("Retrieval successful"))
+    job = models.start_scrape_job(models.NUMBER_RETRIEVAL_DAYS)
+    return JsonResponse(get_scrape_status(job), status=202)
+
+
+#
+# Progress of a scrape job (?job=<id>, default:  the latest one), when the last one succeeded, and the gyms being
+# scraped right now
+#
+def get_scrape_status_page(request):
+    models.fail_stale_scrape_jobs()
+    try:
+        job = models.ScrapeJob.objects.get(pk=int(request.GET['job'])) if request.GET.get('job') else \
+            models.ScrapeJob.objects.order_by('-requested_at', '-id').first()
+    except (ValueError, models.ScrapeJob.DoesNotExist):
+        return JsonResponse({'error': "Unknown job:  {}".format(request.GET['job'])}, status=404)
+    return JsonResponse(get_scrape_status(job))
+
+
+def get_scrape_status(job):
+    last_success = models.ScrapeJob.objects.filter(status=models.ScrapeJob.SUCCEEDED) \
+        .order_by('-finished_at').values_list('finished_at', flat=True).first()
+    return {
+        'job': get_job_json(job) if job else None,
+        'last_completed_at': last_success,
+        'locked_gyms': sorted(gym.split('.')[-1] for gym in models.ScrapeLock.objects.values_list('gym', flat=True)),
+    }
+
+
+def get_job_json(job):
+    return {
+        'id': job.pk,
+        'status': job.status,
+        'number_of_days': job.number_of_days,
+        'requested_at': job.requested_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+        'batches_done': job.batches_done,
+        'batches_total': job.batches_total,
+        'classes_stored': job.classes_stored,
+        'skipped_gyms': job.skipped_gyms.split(',') if job.skipped_gyms else [],
+        'error': job.error or None,
+    }
 
 
 # TODO - clean up
@@ -310,12 +370,19 @@ def get_list_category(easton_class):
 
 
 # TODO - clean up
+# Compiled once for get_calendar_category
+CALENDAR_BJJ_PATTERN = re.compile(".*?([Rr]andori|B[Jj][Jj]|No(-| )Gi|Drilling).*?")
+CALENDAR_PRIVATE_LESSON_PATTERN = re.compile(".*?Private Lesson.*?")
+CALENDAR_MUAY_THAI_PATTERN = re.compile(".*?(Muay [Tt]hai|[Kk]ickboxing).*?")
+CALENDAR_KIDS_MUAY_THAI_PATTERN = re.compile(".*?Kids [Mm]uay [Tt]hai.*?")
+CALENDAR_LITTLE_TIGERS_PATTERN = re.compile(".*?Little Tigers.*?")
+
+
 def get_calendar_category(easton_class):
     if "Fitness" in easton_class.name:
         easton_class.category_enum = EastonClassCategory.CONDITIONING
         easton_class.requirements = EastonRequirements.NONE
-    bjj_pattern = re.compile(".*?([Rr]andori|B[Jj][Jj]|No(-| )Gi|Drilling).*?")
-    if bjj_pattern.match(easton_class.name):
+    if CALENDAR_BJJ_PATTERN.match(easton_class.name):
         easton_class.category_enum = EastonClassCategory.BJJ
         if "Teen BJJ" in easton_class.name:
             easton_class.requirements = EastonRequirements.INVITATION
@@ -331,26 +398,22 @@ def get_calendar_category(easton_class):
              "Family" in easton_class.name or \
              "Drilling" in easton_class.name:
             easton_class.requirements = EastonRequirements.NONE
-    private_lesson_pattern = re.compile(".*?Private Lesson.*?")
-    if private_lesson_pattern.match(easton_class.name):
+    if CALENDAR_PRIVATE_LESSON_PATTERN.match(easton_class.name):
         easton_class.category_enum = EastonClassCategory.PRIVATE_LESSON
         easton_class.requirements = EastonRequirements.NONE
-    muay_thai_pattern = re.compile(".*?(Muay [Tt]hai|[Kk]ickboxing).*?")
-    if muay_thai_pattern.match(easton_class.name):
+    if CALENDAR_MUAY_THAI_PATTERN.match(easton_class.name):
         easton_class.category_enum = EastonClassCategory.STRIKING
         if "Muay Thai" in easton_class.name:
             easton_class.requirements = EastonRequirements.YELLOW_SHIRT
         elif "Kickboxing" in easton_class.name:
             easton_class.requirements = EastonRequirements.NONE
-    kids_muay_thai_pattern = re.compile(".*?Kids [Mm]uay [Tt]hai.*?")
-    if kids_muay_thai_pattern.match(easton_class.name):
+    if CALENDAR_KIDS_MUAY_THAI_PATTERN.match(easton_class.name):
         easton_class.category_enum = EastonClassCategory.KIDS_STRIKING
         easton_class.requirements = EastonRequirements.NONE
-    kids_muay_thai_pattern = re.compile(".*?Little Tigers.*?")
     if "Kids Competition" in easton_class.name:
         easton_class.category_enum = EastonClassCategory.KIDS_BJJ
         easton_class.requirements = EastonRequirements.YELLOW_BELT
-    if kids_muay_thai_pattern.match(easton_class.name):
+    if CALENDAR_LITTLE_TIGERS_PATTERN.match(easton_class.name):
         easton_class.category_enum = EastonClassCategory.LITTLE_TIGERS
         easton_class.requirements = EastonRequirements.NONE
     elif "Tigers" in easton_class.name:
@@ -497,23 +560,240 @@ def get_select_page(request):
     return HttpResponse(template.render(context, request))
 
 
+#
+# Class search results
+#
+# With no paging parameters every match is rendered in one page.  Optional query parameters:
+# page-size:  render at most this many classes (capped at MAX_PAGE_SIZE), with a link to the next page
+# after:  page cursor from a previous page's link
+# stream:  render classes as they're read from the database instead of building the whole page first
+#
 def get_checks(request):
 
-    # If no specific values are specified for a category, return all values for that category
+    try:
+        class_filters = get_class_filters(request)
+        page_size = int(request.GET['page-size']) if request.GET.get('page-size') else None
+        if page_size is not None and page_size < 1:
+            raise ValueError("page-size must be positive")
+        after = parse_page_cursor(request.GET.get('after'))
+        easton_class_list = models.get_classes(**class_filters)
+    except (IndexError, KeyError, ValueError) as e:
+        return HttpResponseBadRequest("Invalid filter:  {}".format(e))
+
+    if request.GET.get('stream'):
+        return StreamingHttpResponse(stream_classes(*get_checks_page(request, easton_class_list, page_size, after)))
+
+    def render_checks():
+        page_classes, next_page = get_checks_page(request, easton_class_list, page_size, after)
+        template = loader.get_template('retriever/index.html')
+        context = {
+            'easton_classes': page_classes,
+            'next_page': next_page
+        }
+        return HttpResponse(template.render(context, request))
+
+    # Every match in one page has no size bound, don't let it into the cache
+    if page_size is None:
+        return render_checks()
+    return RESPONSE_CACHE.get_response(get_response_cache_key('checks', class_filters, page_size, after),
+                                       render_checks)
+
+
+#
+# returns:  (classes to render, query string of the next page or None), every class if page_size is None
+#
+def get_checks_page(request, easton_class_list, page_size, after):
+    if page_size is None:
+        return easton_class_list, None
+    page_classes, last_class = models.get_class_page(easton_class_list, min(page_size, MAX_PAGE_SIZE), after)
+    if last_class is None:
+        return page_classes, None
+    next_query = request.GET.copy()
+    next_query['after'] = format_page_cursor(last_class)
+    return page_classes, next_query.urlencode()
+
+
+#
+# Class search results as JSON, for the mobile clients
+#
+# Takes the same query parameters as get_checks except paging.  Rows are read as dicts of CLASS_JSON_FIELDS with
+# values(), no model instances or templates.  Without a start-date, only classes from today on are returned.
+#
+def get_classes_json(request):
+
+    try:
+        class_filters = get_class_filters(request)
+        if class_filters['start_time'] is None:
+            # The start of today (at the gyms, like the scraper) rather than now, so repeated polls share a cached
+            # response
+            class_filters['start_time'] = parse_filter_date(
+                datetime.now(pytz.timezone('US/Mountain')).strftime('%Y-%m-%d'))
+        easton_class_list = models.get_classes(**class_filters)
+    except (IndexError, KeyError, ValueError) as e:
+        return JsonResponse({'error': "Invalid filter:  {}".format(e)}, status=400)
+
+    def render_classes_json():
+        easton_classes = list(easton_class_list.values(*CLASS_JSON_FIELDS))
+        return JsonResponse({'classes': easton_classes})
+
+    return RESPONSE_CACHE.get_response(get_response_cache_key('json', class_filters), render_classes_json)
+
+
+#
+# Scrape metrics (see models.SCRAPE_METRICS) and cache statistics in the Prometheus text format
+#
+def get_metrics(request):
+
+    classification = models.CLASS_CLASSIFIER.cache_info()
+    cache_gauges = {
+        'http_cache_requests': models.HTTP_CACHE.stats.requests,
+        'http_cache_not_modified': models.HTTP_CACHE.stats.not_modified,
+        'http_cache_bytes_saved': models.HTTP_CACHE.stats.bytes_saved,
+        'response_cache_hits': RESPONSE_CACHE.stats.hits,
+        'response_cache_misses': RESPONSE_CACHE.stats.misses,
+        'classification_cache_hits': classification.hits,
+        'classification_cache_misses': classification.misses,
+    }
+    return HttpResponse(models.SCRAPE_METRICS.render(cache_gauges), content_type='text/plain; version=0.0.4')
+
+
+#
+# In-memory LRU cache of rendered search responses
+#
+# Entries are keyed by the schedule version (models.get_schedule_version) and the normalized search, so a scrape
+# makes every cached response unreachable; the first request under a new version drops them all.  Only the
+# body and content type are kept, each hit gets a new HttpResponse.
+#
+# Bounded by both max_entries and max_bytes of bodies; a body larger than max_bytes on its own isn't cached.
+#
+class ResponseCache:
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self._max_entries = max_entries or getattr(settings, 'SCRAPER_RESPONSE_CACHE_SIZE',
+                                                   DEFAULT_RESPONSE_CACHE_SIZE)
+        self._max_bytes = max_bytes or getattr(settings, 'SCRAPER_RESPONSE_CACHE_BYTES', DEFAULT_RESPONSE_CACHE_BYTES)
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.stats = models.CacheStats()
+
+    #
+    # returns:  the cached response for key under the current schedule version, or build_response()'s, cached
+    # if it succeeded
+    #
+    def get_response(self, key, build_response):
+        version = models.get_schedule_version()
+        with self._lock:
+            if version != self._version:
+                self._clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        self.stats.record(entry is not None)
+        if entry is not None:
+            return HttpResponse(entry[0], content_type=entry[1])
+
+        response = build_response()
+        # A scrape that finished while this response was built makes it stale already
+        if response.status_code == 200 and len(response.content) <= self._max_bytes and \
+                models.get_schedule_version() == version:
+            with self._lock:
+                if version == self._version:
+                    old_entry = self._entries.pop(key, None)
+                    if old_entry is not None:
+                        self._bytes -= len(old_entry[0])
+                    self._entries[key] = (response.content, response['Content-Type'])
+                    self._bytes += len(response.content)
+                    while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                        self._bytes -= len(self._entries.popitem(last=False)[1][0])
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+# Filters from get_class_filters, order-independent, plus any other parameters that change the response
+def get_response_cache_key(view_name, class_filters, *extra):
+    return (view_name,
+            tuple(sorted(class_filters['gym_list'])),
+            tuple(sorted(class_filters['class_type_list'])),
+            tuple(sorted(class_filters['requirements_list'])),
+            class_filters['start_time'],
+            class_filters['end_time']) + extra
+
+
+#
+# Renders the same markup as index.html one class at a time, reading a queryset STREAM_CHUNK_SIZE rows at a time,
+# so memory use doesn't depend on the number of matches
+#
+def stream_classes(easton_class_list, next_page=None):
+    class_template = loader.get_template('retriever/class.html')
+    if hasattr(easton_class_list, 'iterator'):
+        easton_class_list = easton_class_list.iterator(chunk_size=STREAM_CHUNK_SIZE)
+    yield "<ul>\n"
+    for easton_class in easton_class_list:
+        yield class_template.render({'easton_class': easton_class})
+    yield "</ul>\n"
+    if next_page:
+        yield '<a href="?{}">Next</a>\n'.format(escape(next_page))
+
+
+# Page cursors are "<start time>_<id>" of the last class on the previous page
+def format_page_cursor(last_class):
+    return "{}_{}".format(last_class[0].isoformat(), last_class[1])
+
+
+def parse_page_cursor(cursor):
+    if not cursor:
+        return None
+    start_time_string, _, class_pk = cursor.rpartition('_')
+    start_time = parse_datetime(start_time_string)
+    if start_time is None:
+        raise ValueError("bad page cursor {}".format(cursor))
+    return start_time, int(class_pk)
+
+
+#
+# Search filters from the select page's query string, as get_classes keyword arguments
+#
+# gym, class-type, requirements:  enum values (e.g. "EastonGym.AR"), repeated; if none are given for a category,
+# all values for that category match
+# start-date, end-date:  optional YYYY-MM-DD, inclusive
+#
+def get_class_filters(request):
+
     gym_list = [gym.split('.')[1] for gym in request.GET.getlist('gym')] if request.GET.get('gym') else \
         [str(e.name) for e in models.EastonGym]
     class_type = [class_type.split('.')[1] for class_type in request.GET.getlist('class-type')] \
         if request.GET.getlist('class-type') else [str(e.name) for e in models.EastonClassCategory]
     requirements = [requirements.split('.')[1] for requirements in request.GET.getlist('requirements')] \
         if request.GET.getlist('requirements') else [str(e.name) for e in models.EastonRequirements]
-    easton_class_list = models.get_classes(gym_list, class_type, requirements)
-
-    template = loader.get_template('retriever/index.html')
-    easton_class_list.sort(key=lambda added_class: added_class.start_time)
-    context = {
-        'easton_classes': easton_class_list
+    start_time = parse_filter_date(request.GET.get('start-date'))
+    end_time = parse_filter_date(request.GET.get('end-date'))
+    return {
+        'gym_list': gym_list,
+        'class_type_list': class_type,
+        'requirements_list': requirements,
+        'start_time': start_time,
+        'end_time': end_time + timedelta(days=1) if end_time else None
     }
-    return HttpResponse(template.render(context, request))
+
+
+# Class times are stored as gym-local wall clock times in the default time zone, so dates are read the same way
+def parse_filter_date(date_string):
+    if not date_string:
+        return None
+    return timezone.make_aware(datetime.strptime(date_string, '%Y-%m-%d'))
 
 
 #def get_checks(request):